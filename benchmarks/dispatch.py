@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+# Per-connection command dispatch cost:
+# building the parsers on every command versus the command registry
+
+import sys
+import timeit
+
+from jammin.command import get_command_dict, get_command, PRINTER
+
+
+class Printer:
+
+    def sprint(self, *args, **kwargs):
+        pass
+
+
+def rebuilt(name, args):
+    _, get_parser = get_command_dict()[name]
+    return get_parser().parse_args(args)
+
+
+def registry(name, args):
+    _, parser = get_command(name)
+    return parser.parse_args(args)
+
+
+def main(number=10000):
+    PRINTER.set(Printer())
+    for name, method in [("rebuilt", rebuilt), ("registry", registry)]:
+        duration = timeit.timeit(
+            lambda: method("request", ["0123456789"]), number=number)
+        print(f"{name:>10s}: {duration / number * 1e6:8.1f} us/command")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Load test: simulated contestants running claim/request/submit cycles
+# against an in-process server running the standard-sum example
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import resource
+import statistics
+
+import asyncssh
+
+from jammin.server import amain, parse_args
+
+EXAMPLE = os.path.join(
+    os.path.dirname(__file__), "..", "example", "standard-sum")
+
+
+def solve(data):
+    count, *values = map(int, data.split())
+    return "".join(f"{n * (n + 1) // 2}\n" for n in values[:count])
+
+
+def count_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+class TCPClient:
+
+    def __init__(self, namespace):
+        self.port = namespace.tcp_port
+
+    async def run(self, command, data=""):
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        writer.write(f"{command}\n{data}".encode())
+        writer.write_eof()
+        result = await reader.read()
+        writer.close()
+        return result.decode()
+
+
+class SSHClient:
+
+    def __init__(self, namespace):
+        self.port = namespace.ssh_port
+
+    async def run(self, command, data=""):
+        async with asyncssh.connect(
+                "localhost", self.port, username="bench",
+                known_hosts=None) as connection:
+            result = await connection.run(command, input=data)
+        return result.stdout
+
+
+async def contestant(client, index, rounds, results):
+    token = (await client.run(f"claim bench-{index}-{id(client)}")).strip()
+    for _ in range(rounds):
+        start = time.perf_counter()
+        data = await client.run(f"request {token}")
+        middle = time.perf_counter()
+        status = await client.run(f"submit {token}", solve(data))
+        stop = time.perf_counter()
+        results["request"].append(middle - start)
+        results["submit"].append(stop - middle)
+        results["failed"] += not status.rstrip().endswith("10 / 10")
+
+
+async def sample(peaks, interval=0.05):
+    while True:
+        peaks["fds"] = max(peaks["fds"], count_fds())
+        await asyncio.sleep(interval)
+
+
+async def bench(namespace, client_class, users, rounds):
+    client = client_class(namespace)
+    results = {"request": [], "submit": [], "failed": 0}
+    peaks = {"fds": count_fds()}
+    sampler = asyncio.create_task(sample(peaks))
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        contestant(client, index, rounds, results)
+        for index in range(users)))
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+
+    cycles = users * rounds
+    print(f"{client_class.__name__[:-6]}: {users} users x {rounds} rounds")
+    print(f"  throughput: {cycles / elapsed:8.1f} cycles/s")
+    for name in ("request", "submit"):
+        values = results[name]
+        print(f"  {name:>7s}  p50 {percentile(values, .50) * 1e3:8.1f} ms"
+              f"  p95 {percentile(values, .95) * 1e3:8.1f} ms"
+              f"  p99 {percentile(values, .99) * 1e3:8.1f} ms"
+              f"  mean {statistics.mean(values) * 1e3:8.1f} ms")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"  peak rss: {rss / 1024:.1f} MB, peak fds: {peaks['fds']}"
+          f", failed: {results['failed']}")
+
+
+async def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="load", epilog="other arguments are passed to the server")
+    parser.add_argument('-u', '--users', type=int, default=50)
+    parser.add_argument('-r', '--rounds', type=int, default=3)
+    parser.add_argument('-i', '--interface', default="both",
+                        choices=["tcp", "ssh", "both"])
+    options, server_args = parser.parse_known_args(args)
+
+    # Start the server in-process
+    namespace = parse_args([
+        "-t", "0", "-s", "0", "-n", "0", *server_args,
+        os.path.join(EXAMPLE, "description.md"),
+        os.path.join(EXAMPLE, "runner.py"),
+        os.path.join(EXAMPLE, "fastsolver.py")])
+    namespace.runner = [sys.executable, *namespace.runner]
+    namespace.solver = [sys.executable, *namespace.solver]
+    namespace.started = asyncio.Event()
+    server = asyncio.create_task(amain(namespace))
+    await namespace.started.wait()
+
+    # Run the benchmarks
+    try:
+        if options.interface in ("tcp", "both"):
+            await bench(namespace, TCPClient, options.users, options.rounds)
+        if options.interface in ("ssh", "both"):
+            await bench(namespace, SSHClient, options.users, options.rounds)
+    finally:
+        server.cancel()
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Request streaming throughput over a local TCP connection:
+# per-line print and drain versus the raw chunk pump
+
+import sys
+import time
+import asyncio
+
+from jammin.stream import create_raw_prompt
+
+
+def make_reader(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+async def per_line(aprint, reader):
+    async for line in reader:
+        await aprint(line.decode(), end='')
+
+
+async def pumped(aprint, reader):
+    await aprint.pump(reader)
+
+
+async def measure(method, data):
+    done = asyncio.Event()
+
+    async def handler(reader, writer):
+        aprint, _ = create_raw_prompt(reader, writer)
+        await method(aprint, make_reader(data))
+        writer.close()
+        done.set()
+
+    server = await asyncio.start_server(handler, "localhost", 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        start = time.perf_counter()
+        reader, writer = await asyncio.open_connection("localhost", port)
+        received = len(await reader.read())
+        elapsed = time.perf_counter() - start
+        await done.wait()
+        writer.close()
+    assert received == len(data)
+    return len(data) / elapsed / 1e6
+
+
+async def main(lines=10**6):
+    data = b"".join(b"%d\n" % (i * 7919) for i in range(lines))
+    print(f"Streaming {len(data) / 1e6:.1f} MB in {lines} lines")
+    for name, method in [("per-line", per_line), ("pump", pumped)]:
+        rate = await measure(method, data)
+        print(f"{name:>10s}: {rate:8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*map(int, sys.argv[1:])))
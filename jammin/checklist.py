@@ -1,6 +1,196 @@
+import os
+import random
+import asyncio
+import statistics
+from dataclasses import dataclass
 
+from .timing import clock, format_duration
+from .stream import CHUNK_SIZE
+from .verdict import parse_verdict, PASSED_CHAR
+from .runner import spawn_runner, close_runner
 
-async def check_list(checks=None, maxseed=1000):
+
+@dataclass
+class Check:
+    seed: int
+    verdicts: bytes = b""
+    duration: int = 0
+    solve: int = None
+    baseline: int = None
+    error: str = None
+
+    @property
+    def passed(self):
+        return (self.error is None and bool(self.verdicts)
+                and self.verdicts.count(PASSED_CHAR) == len(self.verdicts))
+
+
+BASELINE = {}
+DEFAULT_BASELINE = None
+
+
+def set_baseline(results):
+    global BASELINE, DEFAULT_BASELINE
+    BASELINE = {
+        check.seed: check.baseline
+        for check in results if check.passed and check.baseline}
+    # Unchecked seeds fall back to the median of the checked ones
+    DEFAULT_BASELINE = None
+    if BASELINE:
+        DEFAULT_BASELINE = statistics.median_low(BASELINE.values())
+
+
+def get_baseline(seed):
+    return BASELINE.get(seed, DEFAULT_BASELINE)
+
+
+async def relay(reader, writer, on_chunk):
+    # The solver might exit without reading all its input
+    try:
+        while not writer.is_closing():
+            chunk = await reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            on_chunk()
+            writer.write(chunk)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def check_seed(runner_program, solver_program, seed):
+    check = Check(seed)
+    start = clock()
+    first_sent = last_received = None
+
+    # Solve time, measured like the attempts: from the first chunk
+    # of input data to the last chunk of output data
+    def sent():
+        nonlocal first_sent
+        if first_sent is None:
+            first_sent = clock()
+
+    def received():
+        nonlocal last_received
+        last_received = clock()
+    runner = await spawn_runner(runner_program, seed)
+    try:
+        solver = await asyncio.create_subprocess_exec(
+            *solver_program,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL)
+        tasks = []
+        try:
+            # Runner input to the solver, solver output to the runner
+            tasks += [
+                asyncio.create_task(
+                    relay(runner.pipe_reader, solver.stdin, sent)),
+                asyncio.create_task(
+                    relay(solver.stdout, runner.pipe_writer, received))]
+            verdicts = bytearray()
+            async for line in runner.stdout:
+                verdicts += parse_verdict(line)
+            check.verdicts = bytes(verdicts)
+            await runner.wait()
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if solver.returncode is None:
+                solver.kill()
+            await solver.wait()
+    except Exception as exc:
+        check.error = repr(exc)
+    finally:
+        await close_runner(runner)
+    check.duration = clock() - start
+    if first_sent is not None and last_received is not None:
+        check.solve = last_received - first_sent
+    return check
+
+
+async def measure_baseline(runner_program, solver_program, results, runs=1):
+    # One run at a time, so that the solver is timed without contending
+    # for the CPU with the other checks
+    for check in results:
+        solves = []
+        for _ in range(runs):
+            run = await check_seed(runner_program, solver_program, check.seed)
+            if not run.passed or run.solve is None:
+                break
+            solves.append(run.solve)
+        else:
+            check.baseline = int(statistics.median(solves))
+
+
+async def check_list(runner_program, solver_program, checks=None,
+                     maxseed=1000, workers=None, timeout=None, runs=1):
     if checks is None:
         checks = maxseed
     assert checks <= maxseed
+    if workers is None:
+        workers = os.cpu_count() or 1
+    loop = asyncio.get_event_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    semaphore = asyncio.Semaphore(workers)
+    seeds = sorted(random.sample(range(maxseed), checks))
+
+    async def target(seed):
+        async with semaphore:
+            return await check_seed(runner_program, solver_program, seed)
+
+    # Checks still running when the time budget is exhausted are dropped
+    tasks = [asyncio.create_task(target(seed)) for seed in seeds]
+    if not tasks:
+        return [], 0
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    results = [task.result() for task in tasks if task in done]
+
+    # The baseline gets what is left of the time budget
+    remaining = None
+    if deadline is not None:
+        remaining = max(0, deadline - loop.time())
+    passed = [check for check in results if check.passed]
+    try:
+        await asyncio.wait_for(measure_baseline(
+            runner_program, solver_program, passed, runs), remaining)
+    except asyncio.TimeoutError:
+        pass
+    return results, len(pending)
+
+
+def format_report(results, unchecked=0, top=5):
+    lines = []
+    failed = [check for check in results if not check.passed]
+    durations = sorted(check.duration for check in results)
+    if durations:
+        median = durations[len(durations) // 2]
+        lines.append(
+            f'Checked {len(results)} seeds against the solver: '
+            f'{len(failed)} failed, '
+            f'{format_duration(median)}s median, '
+            f'{format_duration(durations[-1])}s max')
+    baselines = sorted(
+        check.baseline for check in results if check.baseline is not None)
+    if baselines:
+        lines.append(
+            f'Solver baseline: '
+            f'{format_duration(baselines[len(baselines) // 2])}s median, '
+            f'{format_duration(baselines[-1])}s max')
+    if unchecked:
+        lines.append(f'Time budget exhausted, {unchecked} seeds unchecked')
+    for check in failed:
+        reason = check.error or check.verdicts.decode() or "no verdict"
+        lines.append(f' - seed {check.seed}: {reason}')
+    slowest = sorted(results, key=lambda check: check.duration)[-top:]
+    if slowest:
+        lines.append('Slowest seeds: ' + ", ".join(
+            f'{check.seed} ({format_duration(check.duration)}s)'
+            for check in reversed(slowest)))
+    return "\n".join(lines)
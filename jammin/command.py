@@ -1,10 +1,10 @@
 import shlex
+import secrets
+import asyncio
 import argparse
-from datetime import datetime
+import contextvars
 from dataclasses import dataclass, field
 
-import mdv
-
 from prompt_toolkit import HTML, ANSI
 from prompt_toolkit.styles import Style
 from prompt_toolkit.history import InMemoryHistory
@@ -13,11 +13,30 @@ from prompt_toolkit.completion import WordCompleter
 from pygments.lexers.shell import BashLexer
 from prompt_toolkit.lexers import PygmentsLexer
 
-from .timing import format_attempt
+from .timing import format_attempt, format_latencies, clock
+from .metrics import (
+    render_metrics, COMMAND_COUNT, COMMAND_DURATION, REQUEST_BYTES,
+    SUBMIT_BYTES)
 from .exception import log_exception
+from .profiler import phase, profile
+from .dataset import open_dataset
+from .description import render_description
+from .verdict import read_verdicts, PASSED_CHAR
 from .configuration import get_configuration
-from .user import get_user, claim_user, get_users
-from .runner import create_runner, get_runner, prompt_to_pipe
+from .user import get_user, claim_user
+from .presence import get_presence
+from .worker import proxy_command
+from .scheduler import SchedulerTimeout
+from .stream import CHUNK_SIZE
+from .compression import CODECS, available_codecs, compress_reader
+from .scoreboard import get_scoreboard
+from .checklist import get_baseline
+from .runner import (
+    create_runner, get_runner, discard_runner, prompt_to_pipe, RemoteRunner)
+
+
+PRINTER = contextvars.ContextVar("Printer")
+ANSWER_IDLE_TIMEOUT = .1
 
 
 @dataclass
@@ -35,28 +54,36 @@ def get_command_dict():
         "claim": (claim_command, claim_parser),
         "request": (request_command, request_parser),
         "submit": (submit_command, submit_parser),
+        "solve": (solve_command, solve_parser),
+        "judge": (judge_command, judge_parser),
+        "scoreboard": (scoreboard_command, scoreboard_parser),
+        "stats": (stats_command, stats_parser),
+        "profile": (profile_command, profile_parser),
         "interact": (interact_command, interact_parser),
     }
 
 
-def get_user_command_dict():
-    dct = get_command_dict()
-    dct.pop("interact")
-    return dct
+class CommandParser(argparse.ArgumentParser):
 
+    # Print to the console of the current session
+    def _print_message(self, message, file=None):
+        if message:
+            PRINTER.get().sprint(message, end="")
 
-def get_command(name, aprint):
-    command, get_parser = get_command_dict()[name]
-    parser = get_parser()
 
-    # Patch print_message so the parser prints to our console
-    parser._print_message = lambda message, file=None: \
-        message and aprint.sprint(message, end="")
+def build_command_registry():
+    return {
+        name: (corofn, get_parser())
+        for name, (corofn, get_parser) in get_command_dict().items()}
+
 
-    return command, parser
+def get_command(name):
+    return COMMANDS[name]
 
 
-async def run_command(command, aprint, aprompt, interactive=False):
+@phase("run_command")
+async def run_command(command, aprint, aprompt, interactive=False,
+                      allowed=None):
 
     # Interact by default
     if not command:
@@ -71,27 +98,39 @@ async def run_command(command, aprint, aprompt, interactive=False):
 
     # Get corresponding command
     try:
-        corofn, parser = get_command(name, aprint)
+        corofn, parser = get_command(name)
     except KeyError:
         await aprint(f"Unknown command {name}")
         return
 
-    # Parse arguments
+    # Parse arguments, the shared parser prints to this session
+    PRINTER.set(aprint)
     try:
         namespace = parser.parse_args(args)
     except SystemExit:
         return
 
+    # Some sessions only support some commands
+    if allowed is not None and not allowed(name, namespace):
+        await aprint(f"The {name} command is not available here")
+        return 3
+
     # Run command
+    start = clock()
+    status = "error"
     try:
         session = Session(aprint, aprompt, interactive)
         status = await corofn(session, **vars(namespace))
     except EOFError:
+        status = "eof"
         raise
     except Exception as exc:
         await aprint(f"Command {name} failed: {exc}")
         log_exception()
         return 1
+    finally:
+        COMMAND_COUNT.inc(command=name, status=status or 0)
+        COMMAND_DURATION.observe((clock() - start) / 1e9, command=name)
 
     # Return status
     return status
@@ -100,7 +139,7 @@ async def run_command(command, aprint, aprompt, interactive=False):
 # Help command
 
 def help_parser():
-    parser = argparse.ArgumentParser(
+    parser = CommandParser(
         prog="help",
         description='Show the help message')
     return parser
@@ -112,15 +151,16 @@ async def help_command(session):
         "<skyblue>Welcome this SSH problem solving interface! :)</skyblue>"))
     await session.aprint()
     await session.aprint("""Here the list of commands:""")
-    for name, (_, get_parser) in get_user_command_dict().items():
-        await session.aprint(f" - {name:9s}: {get_parser().description}")
+    for name in USER_COMMANDS:
+        _, parser = get_command(name)
+        await session.aprint(f" - {name:10s}: {parser.description}")
     await session.aprint()
 
 
 # Show command
 
 def show_parser():
-    parser = argparse.ArgumentParser(
+    parser = CommandParser(
         prog="show",
         description='Show the problem description')
     return parser
@@ -128,15 +168,14 @@ def show_parser():
 
 async def show_command(session):
     columns = session.aprompt.get_size().columns
-    with open(session.configuration.description) as f:
-        data = mdv.main(f.read(), cols=columns)
+    data = render_description(session.configuration.description, columns)
     await session.aprint(ANSI(data))
 
 
 # Claim command
 
 def claim_parser():
-    parser = argparse.ArgumentParser(
+    parser = CommandParser(
         prog="claim",
         description='Claim a username and receive a token')
     parser.add_argument(
@@ -148,7 +187,7 @@ def claim_parser():
 async def claim_command(session, username):
     # Get user
     try:
-        token = claim_user(username)
+        token = await claim_user(username)
     except ValueError:
         await session.aprint(
             "This user name is already taken :)")
@@ -168,15 +207,38 @@ async def claim_command(session, username):
 # Request command
 
 def request_parser():
-    parser = argparse.ArgumentParser(
+    parser = CommandParser(
         prog="request",
         description='Request a new input dataset')
     parser.add_argument(
         'token', metavar='TOKEN', type=str, help='User token')
+    parser.add_argument(
+        '-z', '--compress', choices=CODECS, default=None,
+        help='compress the input dataset')
     return parser
 
 
-async def request_command(session, token):
+async def check_compression(session, codec):
+    if codec is None:
+        return True
+    if session.configuration.interactive:
+        await session.aprint(
+            "Compression is not available for interactive problems")
+        return False
+    if not hasattr(session.aprompt, "splice"):
+        await session.aprint(
+            "Compressed data is transferred over a raw connection, "
+            "please run this command without a terminal")
+        return False
+    if codec not in available_codecs():
+        await session.aprint(
+            f"The {codec} compression is not available on this server")
+        return False
+    return True
+
+
+@phase("request_command")
+async def request_command(session, token, compress=None):
 
     # Check session
     if session.configuration.interactive and session.interactive:
@@ -187,83 +249,170 @@ async def request_command(session, token):
 
     # Get user
     try:
-        user = get_user(token)
+        user = await get_user(token)
     except KeyError:
         await session.aprint(
             "Authentification failed: this token is not valid :(")
         return 2
 
+    # Check compression
+    if not await check_compression(session, compress):
+        return 3
+
     # Get input data
-    runner = await create_runner(user, session.configuration.runner)
+    try:
+        runner = await create_runner(user, session.configuration.runner)
+    except SchedulerTimeout:
+        await session.aprint(
+            "The server is busy at the moment, please try again later")
+        return 4
+    if session.configuration.interactive:
+        reader = runner.pipe_reader
+    else:
+        reader = await open_dataset(runner)
+
+    # Compressed data is timed from the first sent chunk
+    if compress is not None:
+        runner.first_sent_line = None
+
+        def sent(chunk):
+            if runner.first_sent_line is None:
+                runner.first_sent_line = clock()
+            REQUEST_BYTES.inc(len(chunk))
+
+        await session.aprint.pump(
+            compress_reader(reader, compress), on_chunk=sent)
+        return
 
     # Get timestamp for the first sent line
-    first_line = await runner.pipe_reader.readline()
-    runner.first_sent_line = datetime.now()
+    first_line = await reader.readline()
+    runner.first_sent_line = clock()
     await session.aprint(first_line.decode(), end='')
+    REQUEST_BYTES.inc(len(first_line))
 
-    # Loop over lines
-    async for line in runner.pipe_reader:
-        await session.aprint(line.decode(), end='')
+    # Forward the remaining data
+    await session.aprint.pump(
+        reader, on_chunk=lambda chunk: REQUEST_BYTES.inc(len(chunk)))
 
 
 # Submit
 
 def submit_parser():
-    parser = argparse.ArgumentParser(
+    parser = CommandParser(
         prog="submit",
         description='Submit output data for latest request input data')
     parser.add_argument(
         'token', metavar='TOKEN', type=str, help='User token')
+    parser.add_argument(
+        '-z', '--compress', choices=CODECS, default=None,
+        help='the output data is compressed')
     return parser
 
 
-async def submit_command(session, token):
-    # Char dict
-    char_dict = {
-        "passed": ".",
-        "failed": "F",
-        "error": "E",
-        "skip": "S"}
-
+@phase("submit_command")
+async def submit_command(session, token, compress=None):
     # Get user
     try:
-        user = get_user(token)
+        user = await get_user(token)
     except KeyError:
         await session.aprint(
             "Authentification failed: this token is not valid :(")
         return 2
 
-    # Interactive mode on interactive problem
+    # Compressed output data
+    if compress is not None:
+        if not await check_compression(session, compress):
+            return 3
+        return await submit_compressed(session, user, token, compress)
+
+    # Interactive problems are judged over a single connection
     if session.configuration.interactive and session.interactive:
-        await session.aprint("Not implemented at the moment!")
+        await session.aprint(
+            "This is an interactive problem, please use judge")
+        return 3
 
     # Allow for early abort
     first_line = await session.aprompt()
 
-    # Get runner
-    runner = await get_runner(user)
+    # Get runner, or forward the submission to the worker owning it
+    try:
+        runner = await get_runner(user)
+    except RemoteRunner as exc:
+        return await proxy_command(
+            session, exc.address, "submit", [token], first_line)
 
-    # Pipe output data
+    # Pipe output data and get results
     async with prompt_to_pipe(first_line, session.aprompt, runner):
+        runner.verdicts = await read_verdicts(runner.stdout, session.aprint)
+
+    # The runner is done
+    await discard_runner(user, runner)
+    return await report_attempt(session, user, runner)
+
+
+async def submit_compressed(session, user, token, codec):
+
+    # Allow for early abort
+    first_chunk = await session.aprompt.reader.read(CHUNK_SIZE)
+
+    # Get runner, or forward the submission to the worker owning it
+    try:
+        runner = await get_runner(user)
+    except RemoteRunner as exc:
+        return await proxy_command(
+            session, exc.address, "submit", [token, "--compress", codec],
+            first_data=first_chunk)
+
+    # Decompress output data and get results
+    runner.last_received_line = clock()
+    try:
+        async with prompt_to_pipe(
+                None, session.aprompt, runner, codec, first_chunk):
+            runner.verdicts = await read_verdicts(
+                runner.stdout, session.aprint)
+
+    # Corrupt data ends the attempt
+    except ValueError as exc:
+        await discard_runner(user, runner)
+        await session.aprint(f"{exc} :(")
+        return 3
+
+    # The runner is done
+    await discard_runner(user, runner)
+    return await report_attempt(session, user, runner)
 
-        # Count the tests
-        passed_tests = 0
-        total_tests = 0
 
-        # Get results
-        async for line in runner.stdout:
-            result = line.decode().strip().lower()
-            char = char_dict.get(result, '?')
-            await session.aprint(char, end='')
+async def report_attempt(session, user, runner, aprint=None):
+    if aprint is None:
+        aprint = session.aprint
 
-            # Count the tests
-            total_tests += 1
-            if char == '.':
-                passed_tests += 1
+    # Count the tests
+    passed_tests = runner.verdicts.count(PASSED_CHAR)
+    total_tests = len(runner.verdicts)
 
+    runner.duration = runner.last_received_line - runner.first_sent_line
     status = format_attempt(runner.first_sent_line, runner.last_received_line)
+
+    # Compare to the reference solver
+    baseline = get_baseline(runner.seed)
+    max_ratio = session.configuration.max_ratio
+    too_slow = False
+    if baseline:
+        ratio = runner.duration / baseline
+        too_slow = max_ratio is not None and ratio > max_ratio
+        status += f" [{ratio:.2f}x]"
+
+    # Rejected attempts are recorded without passed tests
+    if too_slow:
+        passed_tests = 0
+    await get_scoreboard().arecord(
+        user, passed_tests, total_tests, runner.duration)
     status += f" {passed_tests} / {total_tests}"
-    await session.aprint("\n" + status)
+    if too_slow:
+        await aprint(
+            f"\nToo slow: more than {max_ratio:g} times "
+            "the reference solver")
+    await aprint("\n" + status)
 
     # Signal failure
     if passed_tests != total_tests:
@@ -273,10 +422,274 @@ async def submit_command(session, token):
     return 0
 
 
+async def relay_attempt(session, runner, reader, progress=None, grace=None):
+    # A turn goes from the first unanswered runner chunk
+    # to the next contestant chunk
+    runner.turns = []
+    runner.first_sent_line = runner.last_received_line = None
+    asked = None
+
+    def sent(chunk):
+        nonlocal asked
+        stamp = clock()
+        if runner.first_sent_line is None:
+            runner.first_sent_line = stamp
+        if asked is None:
+            asked = stamp
+        REQUEST_BYTES.inc(len(chunk))
+
+    def received(chunk):
+        nonlocal asked
+        stamp = runner.last_received_line = clock()
+        if asked is not None:
+            runner.turns.append(stamp - asked)
+            asked = None
+        SUBMIT_BYTES.inc(len(chunk))
+
+    async def answers():
+        await session.aprompt.splice(runner.pipe_writer, on_chunk=received)
+        runner.pipe_writer.close()
+
+    # Relay both directions chunk by chunk
+    tasks = [
+        asyncio.create_task(session.aprint.pump(reader, on_chunk=sent)),
+        asyncio.create_task(answers())]
+    try:
+        runner.verdicts = await read_verdicts(runner.stdout, progress)
+        await tasks[0]
+        # The runner has all the output data it expects: only wait for
+        # the contestant while it keeps sending, closing the connection
+        # with unread data would reset it before the verdicts are read
+        last = None
+        while grace and runner.last_received_line != last:
+            last = runner.last_received_line
+            done, _ = await asyncio.wait([tasks[1]], timeout=grace)
+            if done:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Solve command
+
+def solve_parser():
+    parser = CommandParser(
+        prog="solve",
+        description='Request input data and submit output data '
+                    'over a single connection')
+    parser.add_argument(
+        'token', metavar='TOKEN', type=str, help='User token')
+    return parser
+
+
+@phase("solve_command")
+async def solve_command(session, token):
+
+    # Check session
+    if session.configuration.interactive:
+        await session.aprint(
+            "This is an interactive problem, please use judge")
+        return 3
+    if not hasattr(session.aprompt, "splice"):
+        await session.aprint(
+            "Input and output data share a raw connection, "
+            "please run this command without a terminal")
+        return 3
+
+    # Get user
+    try:
+        user = await get_user(token)
+    except KeyError:
+        await session.aprint(
+            "Authentification failed: this token is not valid :(")
+        return 2
+
+    # Get runner
+    try:
+        runner = await create_runner(user, session.configuration.runner)
+    except SchedulerTimeout:
+        await session.aprint(
+            "The server is busy at the moment, please try again later")
+        return 4
+    reader = await open_dataset(runner)
+
+    # Verdicts go to the side channel (ssh stderr) as they come, or once
+    # the runner is done with the output data
+    side = session.aprint.side
+    grace = ANSWER_IDLE_TIMEOUT if side is None else None
+    await relay_attempt(session, runner, reader, side, grace)
+
+    # The runner is done
+    await discard_runner(user, runner)
+    if runner.last_received_line is None:
+        runner.first_sent_line = runner.last_received_line = clock()
+    if side is None:
+        await session.aprint(runner.verdicts.decode(), end="")
+    return await report_attempt(session, user, runner, side)
+
+
+# Judge command
+
+def judge_parser():
+    parser = CommandParser(
+        prog="judge",
+        description='Solve an interactive problem over a single connection')
+    parser.add_argument(
+        'token', metavar='TOKEN', type=str, help='User token')
+    return parser
+
+
+@phase("judge_command")
+async def judge_command(session, token):
+
+    # Check session
+    if not session.configuration.interactive:
+        await session.aprint(
+            "This is not an interactive problem, "
+            "please use request and submit")
+        return 3
+    if not hasattr(session.aprompt, "splice"):
+        await session.aprint(
+            "Interactive problems are judged over a raw connection, "
+            "please run this command without a terminal")
+        return 3
+
+    # Get user
+    try:
+        user = await get_user(token)
+    except KeyError:
+        await session.aprint(
+            "Authentification failed: this token is not valid :(")
+        return 2
+
+    # Get runner
+    try:
+        runner = await create_runner(user, session.configuration.runner)
+    except SchedulerTimeout:
+        await session.aprint(
+            "The server is busy at the moment, please try again later")
+        return 4
+    session.aprint.nodelay()
+
+    await relay_attempt(session, runner, runner.pipe_reader)
+
+    # The runner is done
+    await discard_runner(user, runner)
+    if runner.turns:
+        await session.aprint(
+            f"{len(runner.turns)} turns, round-trip "
+            f"{format_latencies(runner.turns)}")
+    if runner.last_received_line is None:
+        runner.first_sent_line = runner.last_received_line = clock()
+    await session.aprint(runner.verdicts.decode(), end="")
+    return await report_attempt(session, user, runner)
+
+
+# Scoreboard command
+
+def scoreboard_parser():
+    parser = CommandParser(
+        prog="scoreboard",
+        description='Show the best attempt of each user')
+    parser.add_argument(
+        '-n', '--top', type=int, default=None,
+        help='number of users to show, defaults to all')
+    parser.add_argument(
+        '-w', '--watch', action='store_true',
+        help='keep showing the scoreboard as it changes')
+    return parser
+
+
+async def scoreboard_command(session, top, watch):
+    scoreboard = get_scoreboard()
+    if not watch:
+        await session.aprint(scoreboard.render(top))
+        return
+
+    # Stream the updates until the client leaves
+    try:
+        async for rendered in scoreboard.watch(top):
+            await session.aprint(rendered + "\n")
+    except ConnectionError:
+        pass
+
+
+# Stats command
+
+def stats_parser():
+    parser = CommandParser(
+        prog="stats",
+        description='Show the server metrics')
+    parser.add_argument(
+        'token', metavar='TOKEN', type=str, help='Admin token')
+    return parser
+
+
+def is_admin(session, token):
+    admin_token = session.configuration.admin_token
+    return admin_token is not None and \
+        secrets.compare_digest(token.encode(), admin_token.encode())
+
+
+async def stats_command(session, token):
+    if not is_admin(session, token):
+        await session.aprint(
+            "Authentification failed: this token is not valid :(")
+        return 2
+    await session.aprint(render_metrics(), end="")
+
+
+# Profile command
+
+def profile_parser():
+    parser = CommandParser(
+        prog="profile",
+        description='Profile the server for a while')
+    parser.add_argument(
+        'token', metavar='TOKEN', type=str, help='Admin token')
+    parser.add_argument(
+        '-d', '--duration', type=float, default=10.,
+        help='profiling duration in seconds')
+    parser.add_argument(
+        '-t', '--threshold', type=float, default=0.1,
+        help='report the callbacks blocking the loop longer '
+             'than this many seconds')
+    parser.add_argument(
+        '-c', '--cprofile', action='store_true',
+        help='also run cProfile and write the pstats')
+    return parser
+
+
+async def profile_command(session, token, duration, threshold, cprofile):
+    if not is_admin(session, token):
+        await session.aprint(
+            "Authentification failed: this token is not valid :(")
+        return 2
+
+    # Profile, phases are attributed by the hooks
+    await session.aprint(f"Profiling for {duration:g} seconds...")
+    try:
+        profiler = await profile(
+            session.configuration.profile_dir, duration, threshold, cprofile)
+    except RuntimeError as exc:
+        await session.aprint(str(exc))
+        return 1
+
+    # Report
+    await session.aprint(
+        f"{len(profiler.handler.messages)} slow callbacks")
+    for stack, elapsed in profiler.top_phases():
+        await session.aprint(f" {elapsed / 1e9:8.3f}s {stack}")
+    for filename in profiler.filenames:
+        await session.aprint(f"Wrote {filename}")
+
+
 # Interact
 
 def interact_parser():
-    parser = argparse.ArgumentParser(
+    parser = CommandParser(
         prog="interact",
         description='Run an interactive session')
     return parser
@@ -293,8 +706,6 @@ async def interact_command(session):
 
     history = InMemoryHistory()
     lexer = PygmentsLexer(BashLexer)
-    completer = WordCompleter(
-        get_user_command_dict(), sentence=True)
     style = Style.from_dict({
         'completion-menu.completion': 'bg:#008888 #ffffff',
         'completion-menu.completion.current': 'bg:#00aaaa #000000',
@@ -302,23 +713,54 @@ async def interact_command(session):
         'scrollbar.button': 'bg:#222222',
     })
 
+    # The toolbar is called on every redraw, only render it on changes
+    toolbar = None
+
+    # Sessions and runners are counted by each worker
+    presence = get_presence()
+    where = "at the moment" if presence.worker is None else \
+        f"on worker {presence.worker} at the moment"
+
     def bottom_toolbar():
-        return HTML(
-            'There are '
-            f'<b><style bg="ansired">{len(get_users())} claimed users</style> '
-            'at the moment</b>!')
-
-    while True:
-        try:
-            command = await session.aprompt(
-                HTML("<b>>>> </b>"),
-                history=history,
-                lexer=lexer,
-                completer=completer,
-                style=style,
-                bottom_toolbar=bottom_toolbar,
-                complete_while_typing=True)
-            await run_command(
-                command, session.aprint, session.aprompt, interactive=True)
-        except KeyboardInterrupt:
-            pass
+        nonlocal toolbar
+        if toolbar is None:
+            toolbar = HTML(
+                'There are '
+                f'<b><style bg="ansired">{values["users"]} claimed users'
+                '</style></b>, '
+                f'<b>{values["sessions"]} sessions</b> and '
+                f'<b>{values["runners"]} live runners</b> '
+                f'{where}!')
+        return toolbar
+
+    def presence_changed(values):
+        nonlocal toolbar
+        toolbar = None
+        session.aprompt.invalidate()
+
+    with presence.watching(presence_changed) as values:
+        while True:
+            try:
+                command = await session.aprompt(
+                    HTML("<b>>>> </b>"),
+                    history=history,
+                    lexer=lexer,
+                    completer=COMPLETER,
+                    style=style,
+                    bottom_toolbar=bottom_toolbar,
+                    complete_while_typing=True)
+                await run_command(
+                    command, session.aprint, session.aprompt,
+                    interactive=True)
+            except KeyboardInterrupt:
+                pass
+
+
+# Command registry, built once
+
+COMMANDS = build_command_registry()
+ADMIN_COMMANDS = ["stats", "profile"]
+USER_COMMANDS = [
+    name for name in COMMANDS
+    if name != "interact" and name not in ADMIN_COMMANDS]
+COMPLETER = WordCompleter(USER_COMMANDS, sentence=True)
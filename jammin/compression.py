@@ -0,0 +1,76 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .stream import CHUNK_SIZE
+
+CODECS = ("zlib", "zstd")
+
+
+def available_codecs():
+    return [
+        codec for codec in CODECS
+        if codec != "zstd" or zstandard is not None]
+
+
+def compressobj(codec):
+    if codec == "zlib":
+        return zlib.compressobj()
+    if codec == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"Compression {codec} is not available")
+
+
+def decompressobj(codec):
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Compression {codec} is not available")
+
+
+class TransformReader:
+
+    # Transform the chunks of a reader on the fly, nothing is buffered
+    # beyond what the (de)compressor keeps internally
+    def __init__(self, reader, transform, flush, pending=b"", on_chunk=None):
+        self.reader = reader
+        self.transform = transform
+        self.flush = flush
+        self.pending = pending
+        self.on_chunk = on_chunk
+
+    async def read(self, n=CHUNK_SIZE):
+        while self.flush is not None:
+            if self.pending:
+                chunk, self.pending = self.pending, b""
+            else:
+                chunk = await self.reader.read(n)
+            if self.on_chunk is not None and chunk:
+                self.on_chunk(chunk)
+            try:
+                if not chunk:
+                    data, self.flush = self.flush(), None
+                    return data
+                data = self.transform(chunk)
+            except Exception as exc:
+                self.flush = None
+                raise ValueError(f"Invalid compressed data ({exc})")
+            if data:
+                return data
+        return b""
+
+
+def compress_reader(reader, codec):
+    compressor = compressobj(codec)
+    return TransformReader(reader, compressor.compress, compressor.flush)
+
+
+def decompress_reader(reader, codec, pending=b"", on_chunk=None):
+    decompressor = decompressobj(codec)
+    flush = getattr(decompressor, "flush", lambda: b"")
+    return TransformReader(
+        reader, decompressor.decompress, flush, pending, on_chunk)
@@ -0,0 +1,156 @@
+import os
+import asyncio
+import pathlib
+import collections
+
+from .exception import log_exception
+from .runner import spawn_runner, terminate_runner
+
+CACHE = None
+EXIT_GRACE = .1
+
+
+def get_dataset_cache():
+    return CACHE
+
+
+def set_dataset_cache(cache):
+    global CACHE
+    CACHE = cache
+
+
+class DatasetCache:
+
+    def __init__(self, path, maxsize=64):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.maxsize = maxsize
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def filename(self, seed):
+        return self.path / f"{seed}.in"
+
+    def __contains__(self, seed):
+        return seed in self.memory or self.filename(seed).exists()
+
+    def _remember(self, seed, data):
+        self.memory[seed] = data
+        self.memory.move_to_end(seed)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def get(self, seed):
+        # Memory tier
+        data = self.memory.get(seed)
+        if data is not None:
+            self.hits += 1
+            self.memory.move_to_end(seed)
+            return data
+
+        # Disk tier
+        try:
+            data = self.filename(seed).read_bytes()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(seed, data)
+        return data
+
+    def put(self, seed, data):
+        # Write atomically so a crash never leaves a truncated dataset
+        filename = self.filename(seed)
+        tmp = filename.with_suffix(f".tmp{os.getpid()}")
+        tmp.write_bytes(data)
+        os.replace(tmp, filename)
+        self._remember(seed, data)
+
+    def stats(self):
+        return {
+            "memory": len(self.memory),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses}
+
+
+async def discard(reader):
+    while await reader.read(2**16):
+        pass
+
+
+async def dataset_complete(runner):
+    # A terminated or killed runner only produced a partial dataset
+    if runner.terminated:
+        return False
+    # A runner keeps running once its input data is sent, unless it
+    # crashed: give it a moment to tell
+    try:
+        returncode = await asyncio.wait_for(runner.wait(), EXIT_GRACE)
+    except asyncio.TimeoutError:
+        returncode = 0
+    return returncode == 0 and not runner.terminated
+
+
+async def tee_to_cache(cache, runner, reader):
+    chunks = []
+    try:
+        while True:
+            chunk = await runner.pipe_reader.read(2**16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            reader.feed_data(chunk)
+        reader.feed_eof()
+        if await dataset_complete(runner):
+            cache.put(runner.seed, b"".join(chunks))
+    except Exception:
+        log_exception()
+    finally:
+        reader.feed_eof()
+
+
+async def open_dataset(runner):
+    cache = get_dataset_cache()
+    if cache is None:
+        return runner.pipe_reader
+    reader = asyncio.StreamReader()
+
+    # Serve cached data, the runner input is only drained
+    data = cache.get(runner.seed)
+    if data is not None:
+        reader.feed_data(data)
+        reader.feed_eof()
+        runner.dataset_task = asyncio.create_task(discard(runner.pipe_reader))
+        return reader
+
+    # Fill the cache while streaming
+    runner.dataset_task = asyncio.create_task(
+        tee_to_cache(cache, runner, reader))
+    return reader
+
+
+async def generate_dataset(cache, runner_program, seed):
+    runner = await spawn_runner(runner_program, seed)
+    try:
+        data = await runner.pipe_reader.read()
+        complete = await dataset_complete(runner)
+    finally:
+        await terminate_runner(runner)
+    if complete:
+        cache.put(seed, data)
+
+
+async def pregenerate(cache, runner_program, seeds, workers=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    semaphore = asyncio.Semaphore(workers)
+
+    async def target(seed):
+        async with semaphore:
+            await generate_dataset(cache, runner_program, seed)
+
+    missing = [seed for seed in seeds if seed not in cache]
+    await asyncio.gather(*map(target, missing))
+    return len(missing)
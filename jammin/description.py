@@ -0,0 +1,62 @@
+import os
+import collections
+
+import mdv
+
+PRERENDER_WIDTHS = [80, 120, 160, 200]
+
+
+class RenderCache:
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, path, columns):
+        key = path, os.stat(path).st_mtime_ns, columns
+        try:
+            data = self.entries[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return data
+
+        # Render and evict the least recently used entries
+        self.misses += 1
+        with open(path) as f:
+            data = mdv.main(f.read(), cols=columns)
+        self.entries[key] = data
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return data
+
+    def prerender(self, path, widths=PRERENDER_WIDTHS):
+        for columns in widths:
+            self.render(path, columns)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses}
+
+
+CACHE = RenderCache()
+
+
+def set_render_cache(cache):
+    global CACHE
+    CACHE = cache
+
+
+def get_render_cache():
+    return CACHE
+
+
+def render_description(path, columns):
+    return CACHE.render(path, columns)
@@ -1,14 +1,87 @@
+import sys
+import time
 import traceback
+import collections
+from functools import lru_cache
 
 import structlog
 import pygments.lexers
 import pygments.formatters
 
+RATE = 10.
+BURST = 20
+SEEN = collections.Counter()
 
-def log_exception():
-    logger = structlog.get_logger()
-    text = traceback.format_exc()
+
+class RateLimiter:
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.suppressed = 0
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+        self.tokens -= 1
+        return True
+
+    def pop_suppressed(self):
+        suppressed, self.suppressed = self.suppressed, 0
+        return suppressed
+
+
+LIMITER = RateLimiter()
+
+
+@lru_cache()
+def get_highlighter():
     formatter = pygments.formatters.get_formatter_by_name("terminal256")
     lexer = pygments.lexers.get_lexer_by_name("pytb", stripall=True)
-    colored = pygments.highlight(text, lexer, formatter)
-    logger.warning(f"Unexpected exception:\n{colored}")
+    return lexer, formatter
+
+
+def highlight(text, stream=None):
+    # Only colorize for terminals, log files get the plain traceback
+    if stream is None:
+        stream = sys.stdout
+    if not stream.isatty():
+        return text
+    return pygments.highlight(text, *get_highlighter())
+
+
+def traceback_key(exc_type, tb):
+    frames = traceback.walk_tb(tb)
+    return exc_type, tuple(
+        (frame.f_code.co_filename, lineno) for frame, lineno in frames)
+
+
+def log_exception():
+    logger = structlog.get_logger()
+    exc_type, exc, tb = sys.exc_info()
+    key = traceback_key(exc_type, tb)
+    SEEN[key] += 1
+    count = SEEN[key]
+
+    # Identical tracebacks are only reported with their count,
+    # less and less often
+    if count & (count - 1):
+        return
+    if not LIMITER.allow():
+        return
+    suppressed = LIMITER.pop_suppressed()
+    extra = {"suppressed": suppressed} if suppressed else {}
+    if count > 1:
+        summary = traceback.format_exception_only(exc_type, exc)[-1].strip()
+        logger.warning(
+            f"Repeated exception: {summary}", count=count, **extra)
+        return
+    text = highlight(traceback.format_exc())
+    logger.warning(f"Unexpected exception:\n{text}", **extra)
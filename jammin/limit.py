@@ -0,0 +1,48 @@
+import os
+import sys
+import argparse
+import resource
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog="limit",
+        description='Apply the runner limits, then execute the runner')
+    parser.add_argument('--cpu', type=int, default=None,
+                        help='the CPU time limit in seconds')
+    parser.add_argument('--memory', type=int, default=None,
+                        help='the address space limit in bytes')
+    parser.add_argument('--cgroup', type=str, default=None,
+                        help='the cgroup directory to join')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='the runner command')
+    namespace = parser.parse_args(args)
+    if namespace.command[:1] == ["--"]:
+        namespace.command = namespace.command[1:]
+    if not namespace.command:
+        parser.error("the runner command is required")
+    return namespace
+
+
+def main(args=None):
+    # Executed in place of the runner: the limits hold from its
+    # first instruction, and its children inherit them
+    namespace = parse_args(args)
+    if namespace.cgroup is not None:
+        with open(os.path.join(namespace.cgroup, "cgroup.procs"), "w") as f:
+            f.write(f"{os.getpid()}\n")
+    if namespace.cpu is not None:
+        resource.setrlimit(
+            resource.RLIMIT_CPU, (namespace.cpu, namespace.cpu + 1))
+    if namespace.memory is not None:
+        resource.setrlimit(
+            resource.RLIMIT_AS, (namespace.memory, namespace.memory))
+    try:
+        os.execvp(namespace.command[0], namespace.command)
+    except OSError as exc:
+        print(f"Cannot execute the runner: {exc}", file=sys.stderr)
+        return 127
+
+
+if __name__ == "__main__":
+    sys.exit(main())
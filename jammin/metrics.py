@@ -0,0 +1,154 @@
+import bisect
+import asyncio
+import collections
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+REGISTRY = []
+
+
+def format_labels(names, values, **extra):
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self.values = collections.defaultdict(int)
+
+    def inc(self, value=1, **labels):
+        self.values[self.key(labels)] += value
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{format_labels(self.labels, key)} {value}"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    # Gauges are sampled from the existing stats when rendered
+    def __init__(self, name, description, function):
+        super().__init__(name, description)
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        if value is not None:
+            yield f"{self.name} {value}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self.counts = {}
+        self.sums = collections.defaultdict(float)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        try:
+            counts = self.counts[key]
+        except KeyError:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def samples(self):
+        for key, counts in sorted(self.counts.items()):
+            total = 0
+            bounds = [*map(str, self.buckets), "+Inf"]
+            for bound, count in zip(bounds, counts):
+                total += count
+                labels = format_labels(self.labels, key, le=bound)
+                yield f"{self.name}_bucket{labels} {total}"
+            labels = format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {self.sums[key]}"
+            yield f"{self.name}_count{labels} {total}"
+
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Server metrics
+
+CONNECTIONS = Counter(
+    "jammin_connections_total",
+    "Accepted connections per interface", ["interface"])
+COMMAND_COUNT = Counter(
+    "jammin_commands_total",
+    "Dispatched commands per name and status", ["command", "status"])
+COMMAND_DURATION = Histogram(
+    "jammin_command_duration_seconds",
+    "Command durations per name", ["command"])
+RUNNER_SPAWN = Histogram(
+    "jammin_runner_spawn_seconds",
+    "Time to spawn a runner and connect its pipes")
+REQUEST_BYTES = Counter(
+    "jammin_request_bytes_total",
+    "Input data bytes sent to the contestants")
+SUBMIT_BYTES = Counter(
+    "jammin_submit_bytes_total",
+    "Output data bytes received from the contestants")
+SUBMIT_LINES = Counter(
+    "jammin_submit_lines_total",
+    "Output data lines received from the contestants")
+
+
+# HTTP exporter
+
+async def metrics_handler(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        method, path, *_ = request.decode().split() or ["", ""]
+        if method == "GET" and path.split("?")[0] == "/metrics":
+            status, content_type = "200 OK", CONTENT_TYPE
+            body = render_metrics().encode()
+        else:
+            status, content_type = "404 Not Found", "text/plain"
+            body = b"Not found\n"
+        writer.write(
+            f"HTTP/1.0 {status}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n".encode() + body)
+        await writer.drain()
+    except (ValueError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host="127.0.0.1", port=9100):
+    return await asyncio.start_server(metrics_handler, host=host, port=port)
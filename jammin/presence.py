@@ -0,0 +1,64 @@
+import asyncio
+from contextlib import contextmanager
+
+COUNTERS = ("users", "sessions", "runners")
+NOTIFY_DELAY = .1
+
+
+class Presence:
+
+    # Live counters, kept up to date by the code changing them
+    # so that reading them is O(1). Sessions and runners are counted
+    # by the current process, the worker if any.
+    def __init__(self):
+        self.values = dict.fromkeys(COUNTERS, 0)
+        self.listeners = set()
+        self.worker = None
+        self.pending = None
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def set(self, name, value):
+        # Listeners are only called on actual changes, at most once
+        # per delay whatever the number of changes
+        if self.values[name] == value:
+            return
+        self.values[name] = value
+        if self.listeners and self.pending is None:
+            loop = asyncio.get_event_loop()
+            self.pending = loop.call_later(NOTIFY_DELAY, self.notify)
+
+    def notify(self):
+        self.pending = None
+        for listener in list(self.listeners):
+            listener(self.values)
+
+    def add(self, name, delta=1):
+        self.set(name, self.values[name] + delta)
+
+    @contextmanager
+    def tracking(self, name):
+        self.add(name)
+        try:
+            yield
+        finally:
+            self.add(name, -1)
+
+    @contextmanager
+    def watching(self, listener):
+        self.listeners.add(listener)
+        try:
+            yield self.values
+        finally:
+            self.listeners.discard(listener)
+            if not self.listeners and self.pending is not None:
+                self.pending.cancel()
+                self.pending = None
+
+
+PRESENCE = Presence()
+
+
+def get_presence():
+    return PRESENCE
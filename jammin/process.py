@@ -0,0 +1,181 @@
+import os
+import sys
+import signal
+import asyncio
+import pathlib
+import itertools
+import threading
+import subprocess
+from dataclasses import dataclass
+
+USAGE = {}
+CGROUP_COUNTER = itertools.count()
+LIMIT_SCRIPT = str(pathlib.Path(__file__).with_name("limit.py"))
+
+
+@dataclass
+class RunnerLimits:
+    cpu: int = None
+    memory: int = None
+    wall: float = None
+    cgroup: str = None
+
+    def create_cgroup(self):
+        if self.cgroup is None:
+            return None
+        path = pathlib.Path(self.cgroup) / \
+            f"runner-{os.getpid()}-{next(CGROUP_COUNTER)}"
+        path.mkdir()
+        if self.memory is not None:
+            (path / "memory.max").write_text(f"{self.memory}\n")
+        return path
+
+    def command(self, args, cgroup=None):
+        # The runner is started through a shim applying the limits
+        # before executing it, so that no instruction runs unlimited
+        options = []
+        if self.cpu is not None:
+            options += ["--cpu", f"{self.cpu}"]
+        if self.memory is not None:
+            options += ["--memory", f"{self.memory}"]
+        if cgroup is not None:
+            options += ["--cgroup", f"{cgroup}"]
+        if not options:
+            return list(args)
+        return [sys.executable, LIMIT_SCRIPT, *options, "--", *args]
+
+
+LIMITS = RunnerLimits()
+
+
+def set_runner_limits(limits):
+    global LIMITS
+    LIMITS = limits
+
+
+def get_runner_limits():
+    return LIMITS
+
+
+def cgroup_available(path):
+    return (pathlib.Path(path) / "cgroup.controllers").exists()
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def read_cgroup_usage(cgroup):
+    usage = {}
+    try:
+        for line in (cgroup / "cpu.stat").read_text().splitlines():
+            key, value = line.split()
+            if key == "usage_usec":
+                usage["cgroup_cpu"] = int(value) / 1e6
+        usage["cgroup_memory"] = int((cgroup / "memory.peak").read_text())
+    except (OSError, ValueError):
+        pass
+    return usage
+
+
+class RunnerProcess:
+
+    def __init__(self, popen, stdout, cgroup=None):
+        self.popen = popen
+        self.pid = popen.pid
+        self.stdout = stdout
+        self.cgroup = cgroup
+        self.returncode = None
+        self.rusage = None
+        self.usage = {}
+        self.loop = asyncio.get_event_loop()
+        self.exited = self.loop.create_future()
+        # Reap with wait4 to get the resource usage of this runner only,
+        # once its pidfd is readable, or from a thread without pidfd
+        try:
+            self.pidfd = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            self.pidfd = None
+            thread = threading.Thread(target=self._wait4, daemon=True)
+            thread.start()
+        else:
+            self.loop.add_reader(self.pidfd, self._reap)
+
+    @classmethod
+    async def spawn(cls, args, pass_fds=(), limits=None):
+        if limits is None:
+            limits = get_runner_limits()
+        cgroup = limits.create_cgroup()
+        popen = subprocess.Popen(
+            limits.command(args, cgroup),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            pass_fds=pass_fds)
+        loop = asyncio.get_event_loop()
+        stdout = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(stdout)
+        await loop.connect_read_pipe(lambda: protocol, popen.stdout)
+        return cls(popen, stdout, cgroup)
+
+    def _reap(self):
+        pid, status, rusage = os.wait4(self.pid, os.WNOHANG)
+        if not pid:
+            return
+        self.loop.remove_reader(self.pidfd)
+        os.close(self.pidfd)
+        self._exit(exit_code(status), rusage)
+
+    def _wait4(self):
+        _, status, rusage = os.wait4(self.pid, 0)
+        self.loop.call_soon_threadsafe(self._exit, exit_code(status), rusage)
+
+    def _exit(self, returncode, rusage):
+        self.returncode = self.popen.returncode = returncode
+        self.rusage = rusage
+        self.usage = {
+            "cpu": rusage.ru_utime + rusage.ru_stime,
+            "memory": rusage.ru_maxrss * 1024,
+            "returncode": returncode}
+        if self.cgroup is not None:
+            self.usage.update(read_cgroup_usage(self.cgroup))
+            try:
+                self.cgroup.rmdir()
+            except OSError:
+                pass
+        self.exited.set_result(returncode)
+
+    def send_signal(self, sig):
+        if self.returncode is not None:
+            raise ProcessLookupError
+        os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    async def wait(self):
+        return await asyncio.shield(self.exited)
+
+
+def record_usage(pid, usage):
+    # Keyed by pid, the runners of a seed run concurrently
+    USAGE[pid] = usage
+
+
+def usage_stats(top=5):
+    if not USAGE:
+        return {"runs": 0}
+    cpu = sorted(
+        ((usage["cpu"], usage.get("seed")) for usage in USAGE.values()),
+        key=lambda item: item[0], reverse=True)
+    return {
+        "runs": len(USAGE),
+        "mean_cpu": sum(value for value, _ in cpu) / len(cpu),
+        "max_cpu": cpu[0][0],
+        "max_memory": max(usage["memory"] for usage in USAGE.values()),
+        "killed": sum(usage["returncode"] < 0 for usage in USAGE.values()),
+        "expensive": [key for _, key in cpu[:top]]}
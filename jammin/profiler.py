@@ -0,0 +1,201 @@
+import os
+import time
+import asyncio
+import logging
+import cProfile
+import pathlib
+import functools
+import contextvars
+import collections
+
+from .timing import clock
+
+PHASES = contextvars.ContextVar("Phases", default=())
+PROFILER = None
+
+
+def get_profiler():
+    return PROFILER
+
+
+def timed_steps(coro, record):
+    # Drive a coroutine step by step, so that only the time spent
+    # running it is recorded, not the time spent waiting
+    value, error = None, None
+    while True:
+        start = clock()
+        try:
+            if error is None:
+                future = coro.send(value)
+            else:
+                future = coro.throw(error)
+        except StopIteration as stop:
+            record(clock() - start)
+            return stop.value
+        except BaseException:
+            record(clock() - start)
+            raise
+        record(clock() - start)
+        try:
+            value, error = (yield future), None
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as exc:
+            value, error = None, exc
+
+
+class TimedCoroutine:
+
+    def __init__(self, coro, record):
+        self.coro = coro
+        self.record = record
+
+    def __await__(self):
+        return timed_steps(self.coro, self.record)
+
+
+def phase(name):
+    # Attribute the time spent running a coroutine function to a named
+    # phase, only while a profile is running
+    def decorator(corofn):
+
+        @functools.wraps(corofn)
+        async def wrapper(*args, **kwargs):
+            profiler = PROFILER
+            if profiler is None:
+                return await corofn(*args, **kwargs)
+            stack = PHASES.get() + (name,)
+            token = PHASES.set(stack)
+            try:
+                return await TimedCoroutine(
+                    corofn(*args, **kwargs),
+                    functools.partial(profiler.record, stack))
+            finally:
+                PHASES.reset(token)
+
+        return wrapper
+    return decorator
+
+
+class SlowCallbackFilter(logging.Filter):
+
+    # Keep the slow callback reports of the asyncio debug mode for the
+    # profile, and let the other records through
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def filter(self, record):
+        if isinstance(record.msg, str) and \
+                record.msg.startswith("Executing "):
+            self.messages.append(record.getMessage())
+            return False
+        return True
+
+
+def dump_tasks(stream, title):
+    tasks = asyncio.all_tasks()
+    print(f"# {title}: {len(tasks)} tasks", file=stream)
+    for task in tasks:
+        print(file=stream)
+        task.print_stack(limit=8, file=stream)
+
+
+class Profiler:
+
+    def __init__(self, path, threshold=0.1, cprofile=False):
+        self.path = pathlib.Path(path)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.prefix = f"profile-{stamp}-{os.getpid()}"
+        self.threshold = threshold
+        self.folded = collections.Counter()
+        self.handler = SlowCallbackFilter()
+        self.cprofile = cProfile.Profile() if cprofile else None
+        self.debug = None
+        self.slow_callback_duration = None
+        self.tasks = None
+        self.filenames = []
+
+    def record(self, stack, elapsed):
+        # Folded stacks hold self running times, the steps of the
+        # children run within the steps of their parent and are subtracted
+        self.folded[stack] += elapsed
+        if len(stack) > 1:
+            self.folded[stack[:-1]] -= elapsed
+
+    def start(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.tasks = open(self.filename("tasks.txt"), "w")
+        dump_tasks(self.tasks, "Start")
+
+        # Slow callbacks are reported by the asyncio debug mode
+        loop = asyncio.get_event_loop()
+        self.debug = loop.get_debug()
+        self.slow_callback_duration = loop.slow_callback_duration
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.threshold
+        logging.getLogger("asyncio").addFilter(self.handler)
+
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+    def stop(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+
+        loop = asyncio.get_event_loop()
+        loop.set_debug(self.debug)
+        loop.slow_callback_duration = self.slow_callback_duration
+        logging.getLogger("asyncio").removeFilter(self.handler)
+
+        dump_tasks(self.tasks, "Stop")
+        self.tasks.close()
+        self.filenames = self.write()
+        return self.filenames
+
+    def filename(self, suffix):
+        return self.path / f"{self.prefix}.{suffix}"
+
+    def write(self):
+        filenames = [pathlib.Path(self.tasks.name)]
+
+        # Phases, in microseconds for flamegraph.pl or speedscope
+        filename = self.filename("folded")
+        with open(filename, "w") as f:
+            for stack, elapsed in sorted(self.folded.items()):
+                if elapsed > 0:
+                    print(f"{';'.join(stack)} {elapsed // 1000}", file=f)
+        filenames.append(filename)
+
+        filename = self.filename("slow.txt")
+        with open(filename, "w") as f:
+            for message in self.handler.messages:
+                print(message, file=f)
+        filenames.append(filename)
+
+        if self.cprofile is not None:
+            filename = self.filename("pstats")
+            self.cprofile.dump_stats(filename)
+            filenames.append(filename)
+        return filenames
+
+    def top_phases(self, top=5):
+        return [
+            (";".join(stack), elapsed)
+            for stack, elapsed in self.folded.most_common(top)
+            if elapsed > 0]
+
+
+async def profile(path, duration, threshold=0.1, cprofile=False):
+    global PROFILER
+    if PROFILER is not None:
+        raise RuntimeError("A profile is already running")
+    profiler = PROFILER = Profiler(path, threshold, cprofile)
+    profiler.start()
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        PROFILER = None
+        profiler.stop()
+    return profiler
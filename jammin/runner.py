@@ -1,28 +1,110 @@
 import os
 import random
 import asyncio
-from datetime import datetime
-from asyncio.subprocess import PIPE
+import collections
 from asyncio.streams import FlowControlMixin
 from contextlib import asynccontextmanager
 
+from .timing import clock
+from .metrics import Gauge, RUNNER_SPAWN, SUBMIT_BYTES, SUBMIT_LINES
+from .exception import log_exception
+from .profiler import phase
+from .presence import PRESENCE
+from .stream import forward
+from .compression import decompress_reader
+from .scheduler import get_scheduler
+from .worker import discard_remote
+from .process import RunnerProcess, get_runner_limits, record_usage
+
 SEED_RANGE = 1000
-RUNNERS = {}
+RUNNERS = collections.OrderedDict()
+POOLS = {}
+MAX_LIVE_RUNNERS = None
+OWNERS = {}
+ADDRESS = None
+
+
+class RemoteRunner(Exception):
+
+    def __init__(self, address):
+        super().__init__(address)
+        self.address = address
+
+
+def set_runner_owners(owners, address):
+    global OWNERS, ADDRESS
+    OWNERS, ADDRESS = owners, address
+
+
+async def call_owners(method, *args):
+    # The owners live in a manager process, keep the round-trips off the loop
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, getattr(OWNERS, method), *args)
+
+
+def set_seed_range(value):
+    global SEED_RANGE
+    SEED_RANGE = value
+
+
+def get_seed_range():
+    return SEED_RANGE
 
 
 @asynccontextmanager
-async def prompt_to_pipe(first_line, aprompt, runner):
+async def prompt_to_pipe(first_line, aprompt, runner, codec=None, pending=b""):
+
+    # Timed as the data arrives, before any decompression
+    def arrived(chunk):
+        runner.last_received_line = clock()
+        SUBMIT_BYTES.inc(len(chunk))
+
+    def received(chunk):
+        arrived(chunk)
+        SUBMIT_LINES.inc(chunk.count(b"\n"))
+
+    def decompressed(chunk):
+        SUBMIT_LINES.inc(chunk.count(b"\n"))
 
     async def target():
         line = first_line
-        while True:
-            runner.last_received_line = datetime.now()
-            runner.pipe_writer.write((line + os.linesep).encode())
-            await runner.pipe_writer.drain()
-            try:
-                line = await aprompt()
-            except EOFError:
-                return
+        try:
+            while True:
+                data = (line + os.linesep).encode()
+                received(data)
+                runner.pipe_writer.write(data)
+                await runner.pipe_writer.drain()
+                try:
+                    line = await aprompt()
+                except EOFError:
+                    break
+        finally:
+            runner.pipe_writer.close()
+
+    async def bulk_target():
+        try:
+            data = (first_line + os.linesep).encode()
+            received(data)
+            runner.pipe_writer.write(data)
+            await aprompt.splice(runner.pipe_writer, on_chunk=received)
+        finally:
+            runner.pipe_writer.close()
+
+    # The runner gets its end of input even if the data is corrupt,
+    # so that the verdicts are not waiting on it
+    async def compressed_target():
+        source = decompress_reader(
+            aprompt.reader, codec, pending, on_chunk=arrived)
+        try:
+            await forward(source, runner.pipe_writer, on_chunk=decompressed)
+        finally:
+            runner.pipe_writer.close()
+
+    # Raw sessions splice their input straight into the pipe
+    if codec is not None:
+        target = compressed_target
+    elif hasattr(aprompt, "splice"):
+        target = bulk_target
 
     try:
         task = asyncio.create_task(target())
@@ -40,8 +122,8 @@ async def create_pipe_reader(path):
     reader = asyncio.StreamReader()
     protocol = asyncio.StreamReaderProtocol(reader)
     pipe = open(path, "r")
-    await loop.connect_read_pipe(lambda: protocol, pipe)
-    return reader
+    transport, _ = await loop.connect_read_pipe(lambda: protocol, pipe)
+    return reader, transport
 
 
 async def create_pipe_writer(path):
@@ -54,49 +136,294 @@ async def create_pipe_writer(path):
     return writer
 
 
-async def create_runner(user, runner_program):
-    runner = RUNNERS.get(user)
-    if runner:
-        try:
-            runner.terminate()
-        except ProcessLookupError:
-            pass
-        else:
-            await runner.wait()
+async def spawn_runner(runner_program, seed=None):
 
     # Generate a seed
-    seed = random.randrange(0, SEED_RANGE)
+    if seed is None:
+        seed = random.randrange(0, SEED_RANGE)
 
     # Create pipe for input data
     input_read, input_write = os.pipe()
-    os.set_inheritable(input_write, True)
 
     # Create pipe for output data
     output_read, output_write = os.pipe()
-    os.set_inheritable(output_read, True)
-
-    # Start the runner process
-    runner = await asyncio.create_subprocess_exec(
-        *runner_program,
-        f"{seed}",
-        f"{input_write}",
-        f"{output_read}",
-        stdin=PIPE,
-        stdout=PIPE,
-        close_fds=False)
+
+    start = clock()
+
+    # Start the runner process, only passing its own pipe ends so
+    # concurrently spawned runners never hold each other's pipes open
+    runner = await RunnerProcess.spawn(
+        [*runner_program, f"{seed}", f"{input_write}", f"{output_read}"],
+        pass_fds=(input_write, output_read))
+    runner.exited.add_done_callback(
+        lambda _: record_usage(runner.pid, dict(runner.usage, seed=seed)))
 
     # Close file descriptors
     os.close(input_write)
     os.close(output_read)
 
     # Connect to pipes
-    runner.pipe_reader = await create_pipe_reader(input_read)
+    runner.seed = seed
+    runner.terminated = False
+    runner.slot = None
+    runner.deadline = None
+    runner.dataset_task = None
+    runner.last_used = asyncio.get_event_loop().time()
+    runner.pipe_reader, runner.pipe_reader_transport = \
+        await create_pipe_reader(input_read)
     runner.pipe_writer = await create_pipe_writer(output_write)
+    RUNNER_SPAWN.observe((clock() - start) / 1e9)
+    return runner
+
+
+async def terminate_runner(runner):
+    runner.terminated = True
+    try:
+        runner.terminate()
+    except ProcessLookupError:
+        pass
+    else:
+        await runner.wait()
+
+
+def kill_runner(runner):
+    runner.terminated = True
+    try:
+        runner.kill()
+    except ProcessLookupError:
+        pass
+
+
+async def close_runner(runner):
+    if runner.deadline is not None:
+        runner.deadline.cancel()
+    await terminate_runner(runner)
+
+    # Release the pipes right away rather than on garbage collection
+    runner.pipe_reader_transport.close()
+    runner.pipe_writer.close()
+    for task in (runner.dataset_task, runner.slot):
+        if task is None:
+            continue
+        try:
+            await task
+        except Exception:
+            pass
+
+
+class RunnerPool:
+
+    def __init__(self, runner_program, size, high_water=None):
+        self.runner_program = runner_program
+        self.size = size
+        self.high_water = max(size, high_water or size)
+        self.target = size
+        self.ready = collections.deque()
+        self.spawning = set()
+        self.wakeup = asyncio.Event()
+        self.hits = 0
+        self.misses = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._refill())
+
+    async def close(self):
+        tasks = [self.task, *self.spawning]
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        while self.ready:
+            await close_runner(self.ready.popleft())
+
+    async def _spawn(self):
+        try:
+            runner = await spawn_runner(self.runner_program)
+        except Exception:
+            log_exception()
+            # Do not respawn a broken runner in a tight loop
+            await asyncio.sleep(1.)
+        else:
+            self.ready.append(runner)
+        finally:
+            self.spawning.discard(asyncio.current_task())
+            self.wakeup.set()
+
+    async def _refill(self):
+        while True:
+            self.wakeup.clear()
+            while len(self.ready) + len(self.spawning) < self.target:
+                self.spawning.add(asyncio.create_task(self._spawn()))
+            await self.wakeup.wait()
+
+    async def get(self):
+        self.wakeup.set()
+
+        # Take a runner from the pool
+        while self.ready:
+            runner = self.ready.popleft()
+            if runner.returncode is not None:
+                await close_runner(runner)
+                continue
+            self.hits += 1
+            # Shrink back towards the base size once bursts are absorbed
+            full = len(self.ready) + len(self.spawning) + 1 >= self.target
+            if full and self.target > self.size:
+                self.target -= 1
+            return runner
+
+        # Grow the pool up to the high-water mark and spawn a fresh runner
+        self.misses += 1
+        self.target = min(self.target + 1, self.high_water)
+        return await spawn_runner(self.runner_program)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": self.size,
+            "high_water": self.high_water,
+            "target": self.target,
+            "ready": len(self.ready),
+            "spawning": len(self.spawning),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else None}
+
+
+def start_pool(runner_program, size, high_water=None):
+    pool = RunnerPool(runner_program, size, high_water)
+    POOLS[tuple(runner_program)] = pool
+    pool.start()
+    return pool
+
+
+async def stop_pool(runner_program):
+    pool = POOLS.pop(tuple(runner_program))
+    await pool.close()
+    return pool
+
+
+async def discard_runner(user, runner=None):
+    # Only unregister the given runner if it is still the latest one
+    if runner is None or RUNNERS.get(user) is runner:
+        runner = RUNNERS.pop(user, None)
+        PRESENCE.set("runners", len(RUNNERS))
+        if ADDRESS is not None:
+            await call_owners("release", user, ADDRESS)
+    if runner is not None:
+        await close_runner(runner)
+
+
+async def expire_runners(ttl):
+    # Runners are ordered from the least recently used
+    deadline = asyncio.get_event_loop().time() - ttl
+    while RUNNERS:
+        user, runner = next(iter(RUNNERS.items()))
+        if runner.last_used > deadline:
+            break
+        await discard_runner(user)
+
+
+async def reap_runners(ttl, interval=None):
+    if interval is None:
+        interval = ttl / 2
+    while True:
+        await asyncio.sleep(interval)
+        await expire_runners(ttl)
+
+
+async def close_runners():
+    while RUNNERS:
+        await discard_runner(next(iter(RUNNERS)))
+
+
+def set_max_live_runners(value):
+    global MAX_LIVE_RUNNERS
+    MAX_LIVE_RUNNERS = value
+
+
+def count_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except FileNotFoundError:
+        return None
+
+
+def runner_stats():
+    return {
+        "runners": len(RUNNERS),
+        "alive": sum(runner.returncode is None for runner in RUNNERS.values()),
+        "pooled": sum(len(pool.ready) for pool in POOLS.values()),
+        "fds": count_fds()}
+
+
+Gauge("jammin_runners",
+      "Runners handed out to users",
+      lambda: len(RUNNERS))
+Gauge("jammin_runners_pooled",
+      "Pre-spawned runners ready to be handed out",
+      lambda: runner_stats()["pooled"])
+Gauge("jammin_open_fds",
+      "Open file descriptors of the server process",
+      count_fds)
+
+
+@phase("create_runner")
+async def create_runner(user, runner_program):
+    await discard_runner(user)
+
+    # Wait for a runner slot
+    scheduler = get_scheduler()
+    await scheduler.acquire(user)
+
+    # Get a runner from the pool if any
+    try:
+        pool = POOLS.get(tuple(runner_program))
+        if pool is None:
+            runner = await spawn_runner(runner_program)
+        else:
+            runner = await pool.get()
+    except BaseException:
+        scheduler.release(user)
+        raise
+    runner.slot = asyncio.create_task(scheduler.hold(user, runner))
+    runner.last_used = asyncio.get_event_loop().time()
+
+    # Wall-clock limit, from the moment the runner is handed out
+    limits = get_runner_limits()
+    if limits.wall is not None:
+        runner.deadline = asyncio.get_event_loop().call_later(
+            limits.wall, kill_runner, runner)
 
     # Set and return
     RUNNERS[user] = runner
+    PRESENCE.set("runners", len(RUNNERS))
+
+    # The previous runner might belong to another worker
+    if ADDRESS is not None:
+        previous = await call_owners("claim", user, ADDRESS)
+        if previous not in (None, ADDRESS):
+            await discard_remote(previous, user)
+
+    # Evict the least recently used runners
+    while MAX_LIVE_RUNNERS is not None and len(RUNNERS) > MAX_LIVE_RUNNERS:
+        await discard_runner(next(iter(RUNNERS)))
     return runner
 
 
 async def get_runner(user):
-    return RUNNERS[user]
+    # The latest runner might belong to another worker
+    if ADDRESS is not None:
+        address = await call_owners("get", user)
+        if address is None:
+            raise KeyError(user)
+        if address != ADDRESS:
+            raise RemoteRunner(address)
+    runner = RUNNERS[user]
+    runner.last_used = asyncio.get_event_loop().time()
+    RUNNERS.move_to_end(user)
+    return runner
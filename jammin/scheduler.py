@@ -0,0 +1,140 @@
+import asyncio
+import collections
+
+from .metrics import Gauge
+
+
+class SchedulerTimeout(Exception):
+    pass
+
+
+class RunnerScheduler:
+
+    def __init__(self, limit=None, user_limit=None, timeout=None):
+        self.limit = limit
+        self.user_limit = user_limit
+        self.timeout = timeout
+        self.running = 0
+        self.per_user = collections.Counter()
+        self.queues = collections.OrderedDict()
+        self.waited = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+        self.timeouts = 0
+
+    def _can_run(self, user):
+        if self.limit is not None and self.running >= self.limit:
+            return False
+        if self.user_limit is not None:
+            return self.per_user[user] < self.user_limit
+        return True
+
+    def _grant(self, user):
+        self.running += 1
+        self.per_user[user] += 1
+
+    def _dispatch(self):
+        # Round-robin over the users with pending requests
+        progress = True
+        while progress and self.queues:
+            progress = False
+            for user in list(self.queues):
+                if not self._can_run(user):
+                    continue
+                queue = self.queues.pop(user)
+                while queue and queue[0].done():
+                    queue.popleft()
+                if queue:
+                    self._grant(user)
+                    queue.popleft().set_result(None)
+                    progress = True
+                if queue:
+                    self.queues[user] = queue
+
+    def _record_wait(self, duration):
+        self.waited += 1
+        self.total_wait += duration
+        self.max_wait = max(self.max_wait, duration)
+
+    def _leave(self, user, future):
+        queue = self.queues.get(user, ())
+        if future in queue:
+            queue.remove(future)
+        if not queue:
+            self.queues.pop(user, None)
+
+    async def acquire(self, user):
+        # Fast path, unless other users are already waiting
+        if not self.queues and self._can_run(user):
+            self._grant(user)
+            return
+
+        # Queue up
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.queues.setdefault(user, collections.deque()).append(future)
+        start = loop.time()
+        try:
+            await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._leave(user, future)
+            raise SchedulerTimeout
+        except asyncio.CancelledError:
+            # A slot granted to a request that gave up goes to the next one
+            if future.done() and not future.cancelled():
+                self.release(user)
+            else:
+                self._leave(user, future)
+            raise
+        finally:
+            self._record_wait(loop.time() - start)
+
+    def release(self, user):
+        self.running -= 1
+        self.per_user[user] -= 1
+        if not self.per_user[user]:
+            del self.per_user[user]
+        self._dispatch()
+
+    async def hold(self, user, runner):
+        # The slot is held for the lifetime of the runner process
+        try:
+            await runner.wait()
+        finally:
+            self.release(user)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "limit": self.limit,
+            "user_limit": self.user_limit,
+            "queued": sum(map(len, self.queues.values())),
+            "queued_users": len(self.queues),
+            "waited": self.waited,
+            "mean_wait": self.total_wait / self.waited if self.waited else 0.,
+            "max_wait": self.max_wait,
+            "timeouts": self.timeouts}
+
+
+SCHEDULER = RunnerScheduler()
+
+
+def set_scheduler(scheduler):
+    global SCHEDULER
+    SCHEDULER = scheduler
+
+
+def get_scheduler():
+    return SCHEDULER
+
+
+Gauge("jammin_scheduler_running",
+      "Runners holding a scheduler slot",
+      lambda: SCHEDULER.running)
+Gauge("jammin_scheduler_queued",
+      "Requests waiting for a scheduler slot",
+      lambda: SCHEDULER.stats()["queued"])
+Gauge("jammin_scheduler_timeouts",
+      "Requests that timed out waiting for a slot",
+      lambda: SCHEDULER.timeouts)
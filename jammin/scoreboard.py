@@ -0,0 +1,187 @@
+import os
+import json
+import fcntl
+import asyncio
+import bisect
+import threading
+from contextlib import contextmanager
+
+from .timing import format_duration
+
+
+class Scoreboard:
+
+    def __init__(self, path=None):
+        self.path = path
+        self.best = {}
+        self.attempts = {}
+        self.ranking = []
+        self.records = 0
+        self.version = 0
+        self.rendered = {}
+        self.waiters = set()
+        self.offset = 0
+        self.journal = None
+        self.writer = None
+        # Records are appended from executor threads through their own
+        # file, the journal is only read from the loop: whole lines are
+        # appended at once, so reading them needs no lock
+        self.lock = threading.Lock()
+        if path is not None:
+            self.journal = open(path, "a+b")
+            self.writer = open(path, "ab")
+            self._catch_up()
+
+    def __len__(self):
+        return len(self.best)
+
+    @contextmanager
+    def locked(self):
+        # Flock does not exclude the threads of a single process
+        with self.lock:
+            fcntl.flock(self.writer, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.writer, fcntl.LOCK_UN)
+
+    def _apply(self, user, passed, total, duration):
+        # Best first: most passed tests, then shortest duration,
+        # then earliest submission. The ranking is a plain sorted list:
+        # lookups are O(log n) but insertions and removals move O(n)
+        # references, still far cheaper than the journal fsync
+        key = (-passed, duration, self.records, user, total)
+        self.records += 1
+        self.attempts[user] = self.attempts.get(user, 0) + 1
+        self.version += 1
+        previous = self.best.get(user)
+        if previous is not None:
+            if previous[:2] <= key[:2]:
+                return
+            del self.ranking[bisect.bisect_left(self.ranking, previous)]
+        self.best[user] = key
+        bisect.insort(self.ranking, key)
+
+    def _catch_up(self):
+        # Apply the records appended since the last read,
+        # possibly by other processes sharing the journal
+        self.journal.seek(self.offset)
+        for line in self.journal:
+            if not line.endswith(b"\n"):
+                break
+            record = json.loads(line)
+            self._apply(
+                record["user"], record["passed"],
+                record["total"], record["duration"])
+            self.offset += len(line)
+
+    def _write(self, user, passed, total, duration):
+        if self.writer is None:
+            return
+        line = json.dumps({
+            "user": user, "passed": passed,
+            "total": total, "duration": duration}) + "\n"
+        with self.locked():
+            self.writer.write(line.encode())
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+
+    def _notify(self):
+        self.rendered.clear()
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def refresh(self):
+        # Cheap when nothing was appended to the journal
+        if self.journal is None:
+            return
+        if os.fstat(self.journal.fileno()).st_size == self.offset:
+            return
+        version = self.version
+        self._catch_up()
+        if self.version != version:
+            self._notify()
+
+    def record(self, user, passed, total, duration):
+        self._write(user, passed, total, duration)
+        return self._recorded(user, passed, total, duration)
+
+    async def arecord(self, user, passed, total, duration):
+        # The journal is locked and synced in an executor
+        if self.writer is not None:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(
+                None, self._write, user, passed, total, duration)
+        return self._recorded(user, passed, total, duration)
+
+    def _recorded(self, user, passed, total, duration):
+        # Shared scoreboards apply the record when reading it back
+        if self.journal is None:
+            self._apply(user, passed, total, duration)
+        else:
+            self._catch_up()
+        self._notify()
+        return self.rank(user)
+
+    def rank(self, user):
+        return bisect.bisect_left(self.ranking, self.best[user]) + 1
+
+    def render(self, top=None):
+        # Rendered once per version, whatever the number of viewers
+        self.refresh()
+        try:
+            return self.rendered[top]
+        except KeyError:
+            pass
+        lines = [f"Scoreboard ({len(self)} users)"]
+        for rank, key in enumerate(self.ranking[:top], 1):
+            passed, duration, _, user, total = key
+            lines.append(
+                f"{rank:>4}. {user:<20} {-passed:>4} / {total:<4} "
+                f"[{format_duration(duration)}] "
+                f"({self.attempts[user]} attempts)")
+        result = self.rendered[top] = "\n".join(lines)
+        return result
+
+    async def wait(self, version, timeout=None):
+        if self.version != version:
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.waiters.discard(waiter)
+
+    async def watch(self, top=None, interval=1.):
+        # Yield the rendered scoreboard on every change, the journal
+        # is polled when shared with other processes
+        timeout = None if self.journal is None else interval
+        version = None
+        while True:
+            rendered = self.render(top)
+            if self.version != version:
+                version = self.version
+                yield rendered
+            await self.wait(version, timeout)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.writer.close()
+            self.journal = self.writer = None
+
+
+SCOREBOARD = Scoreboard()
+
+
+def set_scoreboard(scoreboard):
+    global SCOREBOARD
+    SCOREBOARD = scoreboard
+
+
+def get_scoreboard():
+    return SCOREBOARD
@@ -1,11 +1,29 @@
+import sys
+import shutil
 import signal
 import asyncio
 import argparse
 from contextlib import contextmanager
 
-from .tcp import start_tcp_server
-from .ssh import start_ssh_server
+from .tcp import start_tcp_server, start_worker_server
+from .ssh import start_ssh_server, ensure_key
+from .user import UserStore, DEFAULT_USERS, set_user_store
+from .scoreboard import Scoreboard, set_scoreboard
 from .configuration import set_configuration
+from .dataset import DatasetCache, set_dataset_cache, pregenerate
+from .description import RenderCache, set_render_cache
+from .scheduler import RunnerScheduler, set_scheduler
+from .checklist import check_list, format_report, set_baseline
+from .metrics import start_metrics_server
+from .presence import get_presence
+from .process import (
+    RunnerLimits, set_runner_limits, cgroup_available, usage_stats)
+from .runner import (
+    start_pool, stop_pool, set_seed_range, set_runner_owners,
+    set_max_live_runners, reap_runners, close_runners)
+from .worker import (
+    reserve_port, worker_address, create_rundir, create_shared_state,
+    start_workers, wait_workers, stop_workers)
 
 
 @contextmanager
@@ -19,31 +37,224 @@ def keyboard_interrupt_control(loop=None):
         loop.remove_signal_handler(signal.SIGINT)
 
 
+def setup_users(namespace):
+    store = UserStore(namespace.users, DEFAULT_USERS)
+    if namespace.register:
+        with open(namespace.register) as f:
+            tokens = store.register(f)
+        for user, token in tokens.items():
+            print(user, token)
+    set_user_store(store)
+    return store
+
+
+async def setup_datasets(namespace):
+    cache = DatasetCache(namespace.cache, namespace.cache_size)
+    set_dataset_cache(cache)
+    if namespace.pregenerate and not namespace.interactive:
+        print(f'Pre-generating datasets in {namespace.cache}...')
+        seeds = range(namespace.maxseed)
+        await pregenerate(cache, namespace.runner, seeds)
+
+
+async def setup_checks(namespace):
+    checks = namespace.ntests
+    if namespace.check_all:
+        checks = namespace.maxseed
+    if not checks:
+        return True
+    print(f'Checking {checks} seeds against the solver...')
+    results, unchecked = await check_list(
+        namespace.runner, namespace.solver, checks,
+        namespace.maxseed, timeout=namespace.check_timeout,
+        runs=namespace.baseline_runs)
+    print(format_report(results, unchecked))
+    set_baseline(results)
+    baseline = any(check.baseline for check in results)
+    if namespace.max_ratio is not None and not baseline:
+        print('No baseline within the time budget, '
+              '--max-ratio is not enforced')
+    return all(check.passed for check in results)
+
+
 async def amain(namespace):
     set_configuration(namespace)
+    set_seed_range(namespace.maxseed)
     if not hasattr(namespace, "started"):
         namespace.started = asyncio.Event()
+    if not hasattr(namespace, "worker"):
+        namespace.worker = None
+    verbose = namespace.worker is None
+    reuse_port = namespace.worker is not None
+
+    # Worker interface, to reach the runners owned by this worker,
+    # set up before accepting any connection on the shared ports
+    if namespace.worker is not None:
+        address = worker_address(namespace.rundir, namespace.worker)
+        worker_server = await start_worker_server(address)
+        set_runner_owners(namespace.shared_owners, address)
+        get_presence().worker = namespace.worker
+
+    # User store
+    setup_users(namespace)
+
+    # Scoreboard
+    set_scoreboard(Scoreboard(namespace.scores))
+
+    # Runner limits
+    cgroup = namespace.cgroup
+    if cgroup is not None and not cgroup_available(cgroup):
+        if verbose:
+            print(f'No cgroup v2 hierarchy in {cgroup}, using rlimits only')
+        cgroup = None
+    set_runner_limits(RunnerLimits(
+        namespace.runner_cpu,
+        namespace.runner_memory,
+        namespace.runner_wall,
+        cgroup))
+
+    # Runner scheduler
+    set_scheduler(RunnerScheduler(
+        namespace.max_runners,
+        namespace.max_user_runners,
+        namespace.queue_timeout))
+
+    # Check the runner against the solver before serving
+    if not await setup_checks(namespace):
+        return 1
+
+    # Problem description
+    render_cache = RenderCache(namespace.render_cache_size)
+    render_cache.prerender(namespace.description, namespace.prerender)
+    set_render_cache(render_cache)
 
     # TCP interface
-    tcp_server = await start_tcp_server(port=namespace.tcp_port)
+    tcp_server = await start_tcp_server(
+        port=namespace.tcp_port, reuse_port=reuse_port)
     namespace.tcp_port = tcp_server.sockets[0].getsockname()[1]
-    print(f'Serving TCP interface on port {namespace.tcp_port}...')
+    if verbose:
+        print(f'Serving TCP interface on port {namespace.tcp_port}...')
 
     # SSH interface
-    ssh_server = await start_ssh_server(port=namespace.ssh_port)
+    ssh_server = await start_ssh_server(
+        port=namespace.ssh_port, reuse_port=reuse_port)
     namespace.ssh_port = ssh_server.sockets[0].getsockname()[1]
+    if verbose:
+        print(f'Serving SSH interface on port {namespace.ssh_port}...')
+
+    # Metrics, one port per worker (or an ephemeral one for port 0)
+    metrics_server = None
+    if namespace.metrics_port is not None:
+        metrics_port = namespace.metrics_port
+        if metrics_port:
+            metrics_port += namespace.worker or 0
+        metrics_server = await start_metrics_server(port=metrics_port)
+        metrics_port = metrics_server.sockets[0].getsockname()[1]
+        if namespace.worker is None:
+            namespace.metrics_port = metrics_port
+        print(f'Serving metrics on port {metrics_port}...')
+
+    # Dataset cache
+    if namespace.cache:
+        await setup_datasets(namespace)
+
+    # Runner pool
+    if namespace.pool_size:
+        start_pool(
+            namespace.runner, namespace.pool_size, namespace.pool_high_water)
+        if verbose:
+            print(f'Pre-spawning {namespace.pool_size} runners...')
+
+    # Runner lifecycle
+    set_max_live_runners(namespace.max_live_runners)
+    reaper = asyncio.create_task(reap_runners(namespace.runner_ttl))
+
+    try:
+        with keyboard_interrupt_control():
+            async with tcp_server, ssh_server:
+                namespace.started.set()
+                if namespace.worker is not None:
+                    namespace.ready.release()
+                await tcp_server.serve_forever()
+    finally:
+        reaper.cancel()
+        await close_runners()
+        if namespace.worker is not None:
+            worker_server.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if namespace.pool_size:
+            pool = await stop_pool(namespace.runner)
+            stats = pool.stats()
+            print(f'Runner pool: {stats["hits"]} hits, '
+                  f'{stats["misses"]} misses')
+        stats = usage_stats()
+        if stats["runs"]:
+            print(f'Runner usage: {stats["runs"]} runs, '
+                  f'{stats["mean_cpu"]:.3f}s mean CPU, '
+                  f'{stats["max_cpu"]:.3f}s max CPU, '
+                  f'{stats["max_memory"] / 2**20:.1f} MiB max memory, '
+                  f'{stats["killed"]} killed, most expensive seeds: '
+                  f'{", ".join(map(str, stats["expensive"]))}')
+
+
+def run_worker(namespace):
+    asyncio.run(amain(namespace))
+
+
+def run_workers(namespace):
+    # Reserve the ports shared by all the workers
+    tcp_socket = reserve_port(namespace.tcp_port)
+    ssh_socket = reserve_port(namespace.ssh_port)
+    namespace.tcp_port = tcp_socket.getsockname()[1]
+    namespace.ssh_port = ssh_socket.getsockname()[1]
+    print(f'Serving TCP interface on port {namespace.tcp_port}...')
     print(f'Serving SSH interface on port {namespace.ssh_port}...')
 
-    # Tests
-    # XXX: TODO
+    # Prepare what the workers would otherwise race for
+    if not asyncio.run(setup_checks(namespace)):
+        return 1
+    namespace.ntests, namespace.check_all = 0, False
+    namespace.rundir = create_rundir()
+    ensure_key()
+    if namespace.users is None:
+        namespace.users = f"{namespace.rundir}/users.log"
+    if namespace.scores is None:
+        namespace.scores = f"{namespace.rundir}/scores.log"
+    setup_users(namespace).close()
+    namespace.register = None
+    if namespace.cache:
+        asyncio.run(setup_datasets(namespace))
+        namespace.pregenerate = False
 
-    with keyboard_interrupt_control():
-        async with tcp_server, ssh_server:
-            namespace.started.set()
-            await tcp_server.serve_forever()
+    # The runner limits are enforced by each worker, split them so
+    # that the whole server stays within them
+    for name in ("max_runners", "max_live_runners"):
+        limit = getattr(namespace, name)
+        if limit is not None:
+            setattr(namespace, name, max(1, limit // namespace.workers))
 
+    # State shared by the workers
+    manager, namespace.shared_owners = create_shared_state()
 
-def main(args=None):
+    # Run the workers, and stop them on termination
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit())
+    processes = start_workers(namespace, run_worker)
+    try:
+        if not wait_workers(namespace, processes):
+            return 1
+        print(f'Running {namespace.workers} workers...', flush=True)
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(processes)
+        manager.shutdown()
+        shutil.rmtree(namespace.rundir, ignore_errors=True)
+
+
+def parse_args(args=None):
 
     parser = argparse.ArgumentParser(
         prog="jammin",
@@ -58,12 +269,121 @@ def main(args=None):
     parser.add_argument('-m', '--maxseed', type=int, default=1000,
                         help='the maximum seed value')
 
-    parser.add_argument('-n', '--ntests', type=int, default=None,
-                        help='the number of tests to run, defaults to all')
+    parser.add_argument('-n', '--ntests', type=int, default=10,
+                        help='the number of random seeds to check against '
+                             'the solver at startup, 0 to skip the checks')
+
+    parser.add_argument('--check-all', action='store_true',
+                        help='check every seed against the solver at startup')
+
+    parser.add_argument('--check-timeout', type=float, default=10.,
+                        help='the time budget of the startup checks '
+                             'in seconds')
+
+    parser.add_argument('--baseline-runs', type=int, default=1,
+                        help='the number of solver runs per checked seed, '
+                             'their median solve time is the baseline '
+                             'attempts are compared to')
+
+    parser.add_argument('--max-ratio', type=float, default=None,
+                        help='reject the attempts slower than this many '
+                             'times the baseline, defaults to no limit')
 
     parser.add_argument('-i', '--interactive', action="store_true",
                         help='indicates an interactive problem')
 
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='the number of server processes')
+
+    parser.add_argument('-p', '--pool-size', type=int, default=0,
+                        help='the number of pre-spawned runners, '
+                             'defaults to no pool')
+
+    parser.add_argument('--pool-high-water', type=int, default=None,
+                        help='the maximum number of pre-spawned runners '
+                             'during bursts, defaults to the pool size')
+
+    parser.add_argument('--max-runners', type=int, default=None,
+                        help='the maximum number of running runners, '
+                             'split between the workers, '
+                             'defaults to no limit')
+
+    parser.add_argument('--max-user-runners', type=int, default=1,
+                        help='the maximum number of running runners per user '
+                             'in each worker')
+
+    parser.add_argument('--queue-timeout', type=float, default=None,
+                        help='how long a request waits for a runner '
+                             'in seconds, defaults to no limit')
+
+    parser.add_argument('--max-live-runners', type=int, default=None,
+                        help='the maximum number of runners kept alive, '
+                             'split between the workers, '
+                             'the least recently used are closed first, '
+                             'defaults to no limit')
+
+    parser.add_argument('--runner-ttl', type=float, default=600.,
+                        help='how long an unused runner is kept alive '
+                             'in seconds')
+
+    parser.add_argument('--runner-cpu', type=int, default=None,
+                        help='the CPU time limit of a runner in seconds')
+
+    parser.add_argument('--runner-memory', type=int, default=None,
+                        help='the address space limit of a runner in bytes')
+
+    parser.add_argument('--runner-wall', type=float, default=None,
+                        help='the wall-clock limit of a runner in seconds, '
+                             'from the moment it is handed out')
+
+    parser.add_argument('--cgroup', metavar='DIR', default=None,
+                        help='a delegated cgroup v2 directory to create '
+                             'the runner cgroups in')
+
+    parser.add_argument('-u', '--users', metavar='FILE', default=None,
+                        help='a journal file to persist the users, '
+                             'defaults to memory only')
+
+    parser.add_argument('-r', '--register', metavar='FILE', default=None,
+                        help='register the users listed in a file '
+                             '(one "USER [TOKEN]" per line) and print '
+                             'their tokens')
+
+    parser.add_argument('--scores', metavar='FILE', default=None,
+                        help='a journal file to persist the submissions, '
+                             'defaults to memory only')
+
+    parser.add_argument('--admin-token', metavar='TOKEN', default=None,
+                        help='the token for the admin commands, '
+                             'defaults to no admin commands')
+
+    parser.add_argument('--profile-dir', metavar='DIR', default='profiles',
+                        help='the directory to write the profiles to')
+
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='a local port to export the metrics over HTTP, '
+                             'the workers use the following ports, '
+                             'defaults to no export')
+
+    parser.add_argument('-c', '--cache', metavar='DIR', default=None,
+                        help='a directory to cache the datasets, '
+                             'defaults to no cache')
+
+    parser.add_argument('--cache-size', type=int, default=64,
+                        help='the number of datasets kept in memory')
+
+    parser.add_argument('--pregenerate', action="store_true",
+                        help='generate all the datasets before serving')
+
+    parser.add_argument('--render-cache-size', type=int, default=32,
+                        help='the number of rendered descriptions to keep')
+
+    parser.add_argument('--prerender', metavar='WIDTHS',
+                        default='80,120,160,200',
+                        type=lambda arg: [int(x) for x in arg.split(',') if x],
+                        help='comma-separated terminal widths to render the '
+                             'description for at startup')
+
     parser.add_argument('description', metavar='DESC', type=str,
                         help='the markdown file containing the problem description')
 
@@ -74,8 +394,19 @@ def main(args=None):
                         help='a valid solution')
 
     namespace = parser.parse_args(args)
+    if namespace.max_ratio is not None and \
+            not namespace.ntests and not namespace.check_all:
+        parser.error('--max-ratio needs a baseline, '
+                     'it cannot be used with -n 0')
     namespace.runner = [namespace.runner]
     namespace.solver = [namespace.solver]
+    return namespace
+
+
+def main(args=None):
+    namespace = parse_args(args)
+    if namespace.workers > 1:
+        return run_workers(namespace)
     return asyncio.run(amain(namespace))
 
 
@@ -4,10 +4,14 @@ import asyncssh
 
 from .command import run_command
 from .exception import log_exception
+from .metrics import CONNECTIONS
+from .presence import PRESENCE
 from .stream import create_raw_prompt, create_full_prompt
 
 
 async def ssh_handler(process):
+    CONNECTIONS.inc(interface="ssh")
+
     # Make sure the process is closed before exiting
     async with process:
 
@@ -16,26 +20,28 @@ async def ssh_handler(process):
         term = process.get_terminal_type()
         interactive = term is not None
 
-        try:
+        # Count the session while it is open
+        with PRESENCE.tracking("sessions"):
+            try:
 
-            # Get the prompt functions
-            if interactive:
-                aprint, aprompt = await create_full_prompt(process)
-            else:
-                aprint, aprompt = create_raw_prompt(
-                    process.stdin, process.stdout)
+                # Get the prompt functions
+                if interactive:
+                    aprint, aprompt = await create_full_prompt(process)
+                else:
+                    aprint, aprompt = create_raw_prompt(
+                        process.stdin, process.stdout, process.stderr)
 
-            # Run the handler
-            status = await run_command(
-                command, aprint, aprompt)
-            process.exit(status or 0)
+                # Run the handler
+                status = await run_command(
+                    command, aprint, aprompt)
+                process.exit(status or 0)
 
-        # Exit cleanly
-        except EOFError:
-            pass
-        except Exception:
-            log_exception()
-            process.exit(-1)
+            # Exit cleanly
+            except EOFError:
+                pass
+            except Exception:
+                log_exception()
+                process.exit(-1)
 
 
 # AsyncSSH server
@@ -55,11 +61,12 @@ def ensure_key(filename="ssh_host_key"):
     return str(path)
 
 
-async def start_ssh_server(host="0.0.0.0", port=0):
+async def start_ssh_server(host="0.0.0.0", port=0, reuse_port=None):
     return await asyncssh.create_server(
         NoAuthSSHServer,
         host,
         port,
+        reuse_port=reuse_port,
         encoding=None,
         line_editor=False,
         server_host_keys=[ensure_key()],
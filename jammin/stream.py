@@ -1,5 +1,7 @@
 
 
+import socket
+
 from prompt_toolkit.application import get_app
 from prompt_toolkit.input.defaults import create_pipe_input
 from prompt_toolkit.layout.screen import Size
@@ -9,6 +11,11 @@ from prompt_toolkit.eventloop.defaults import use_asyncio_event_loop
 from prompt_toolkit import prompt, print_formatted_text
 from prompt_toolkit.formatted_text import FormattedText, to_formatted_text
 
+from .profiler import phase
+
+CHUNK_SIZE = 2**16
+HIGH_WATER = 2**18
+
 
 def to_text(val):
     if isinstance(val, list) and not isinstance(val, FormattedText):
@@ -28,7 +35,25 @@ def to_fragments(values, sep, end):
     return fragments
 
 
-def create_raw_prompt(reader, writer):
+async def forward(reader, writer, on_chunk=None,
+                  chunk_size=CHUNK_SIZE, high_water=HIGH_WATER):
+    # Forward raw chunks, only draining past the high-water mark
+    buffered = 0
+    while True:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            break
+        writer.write(chunk)
+        if on_chunk is not None:
+            on_chunk(chunk)
+        buffered += len(chunk)
+        if buffered >= high_water:
+            await writer.drain()
+            buffered = 0
+    await writer.drain()
+
+
+def create_raw_prompt(reader, writer, side_writer=None):
     writer.flush = lambda: None
 
     def sprint(*values, sep=' ', end='\n', **kwargs):
@@ -50,10 +75,33 @@ def create_raw_prompt(reader, writer):
             raise EOFError
         return data.rstrip('\n')
 
+    def pump(source, **kwargs):
+        return forward(source, writer, **kwargs)
+
+    def splice(destination, **kwargs):
+        return forward(reader, destination, **kwargs)
+
+    def nodelay():
+        # Interactive exchanges are not worth delaying to fill segments
+        sock = writer.get_extra_info("socket")
+        if sock is not None and sock.family in (
+                socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
     aprint.sprint = sprint
+    aprint.pump = pump
+    aprint.nodelay = nodelay
+    aprint.side = None
+    if side_writer is not None:
+        aprint.side, _ = create_raw_prompt(None, side_writer)
+    aprompt.splice = splice
+    aprompt.reader = reader
+    aprompt.get_size = lambda: Size(rows=24, columns=80)
+    aprompt.invalidate = lambda: None
     return aprint, aprompt
 
 
+@phase("create_full_prompt")
 async def create_full_prompt(process):
     # Mandatory from prompt_toolkit
     context_id = None
@@ -93,6 +141,12 @@ async def create_full_prompt(process):
         sprint(*args, **kwargs)
         await process.stdout.drain()
 
+    async def pump(reader, on_chunk=None, **kwargs):
+        async for line in reader:
+            await aprint(line.decode(), end='')
+            if on_chunk is not None:
+                on_chunk(line)
+
     # Define local prompt
 
     async def aprompt(*args, **kwargs):
@@ -103,6 +157,16 @@ async def create_full_prompt(process):
         with context() as context_id:
             return await prompt(*args, **kwargs)
 
+    # Redraw the running prompt, if any
+
+    def invalidate():
+        with context(context_id):
+            app = get_app(return_none=True)
+        if app is not None:
+            app.invalidate()
+
     aprompt.get_size = vt100_output.get_size
+    aprompt.invalidate = invalidate
     aprint.sprint = sprint
+    aprint.pump = pump
     return aprint, aprompt
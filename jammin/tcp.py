@@ -1,15 +1,160 @@
+import shlex
 import asyncio
 
 from .command import run_command
 from .exception import log_exception
+from .metrics import CONNECTIONS
+from .presence import PRESENCE
 from .stream import create_raw_prompt
+from .runner import discard_runner
+from .worker import STATUS_SEPARATOR, DISCARD_COMMAND
+
+
+PIPELINE_KEYWORD = "pipeline"
+PIPELINE_COMMANDS = ("request", "submit", "claim", "scoreboard")
+MAX_FRAME_SIZE = 2**26
+MAX_LINE_SIZE = 2**16
+CHUNK_SIZE = 2**16
+
+
+def framable(name, namespace):
+    # Commands with a bounded output and no raw connection
+    return name in PIPELINE_COMMANDS and not getattr(namespace, "watch", False)
+
+
+class ChunkWriter:
+
+    # Frame everything written as length-prefixed chunks
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, data):
+        if data:
+            self.writer.write(b"%d\n" % len(data))
+            self.writer.write(data)
+
+    def end(self, status):
+        self.writer.write(b"0 %d\n" % status)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def get_extra_info(self, name, default=None):
+        return self.writer.get_extra_info(name, default)
+
+    # The response ends with the status chunk, not with the connection
+    def can_write_eof(self):
+        return False
+
+    def write_eof(self):
+        pass
+
+    def close(self):
+        pass
+
+    def is_closing(self):
+        return self.writer.is_closing()
+
+
+class FrameReader:
+
+    # Stream the frame body from the connection instead of buffering it
+    def __init__(self, reader, size):
+        self.reader = reader
+        self.remaining = size
+        self.buffer = b""
+        self.truncated = False
+
+    async def _fill(self):
+        data = b""
+        if self.remaining:
+            data = await self.reader.read(min(self.remaining, CHUNK_SIZE))
+        if not data:
+            self.truncated = self.remaining > 0
+            self.remaining = 0
+        self.remaining -= len(data)
+        self.buffer += data
+        return data
+
+    async def read(self, n=-1):
+        if not self.buffer:
+            await self._fill()
+        if n < 0:
+            n = len(self.buffer)
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    async def readline(self):
+        # Same line limit as the plain connections
+        while b"\n" not in self.buffer:
+            if len(self.buffer) > MAX_LINE_SIZE:
+                raise ValueError("Line is too long")
+            if not await self._fill():
+                break
+        line, sep, self.buffer = self.buffer.partition(b"\n")
+        return line + sep
+
+    async def discard(self):
+        # Skip what the command did not read, up to the next frame
+        self.buffer = b""
+        while await self._fill():
+            self.buffer = b""
+
+
+async def read_frame(reader):
+    header = await reader.readline()
+    if not header:
+        raise EOFError
+    size = int(header)
+    if not 0 < size <= MAX_FRAME_SIZE:
+        raise ValueError(f"Invalid frame size {size}")
+    return FrameReader(reader, size)
+
+
+async def pipeline_handler(reader, writer):
+    # Each request frame holds a command line and its input data, each
+    # response is a series of chunks ending with the command status
+    while True:
+        try:
+            frame_reader = await read_frame(reader)
+        except EOFError:
+            return
+        except ValueError:
+            writer.write(b"Invalid frame\n")
+            return
+        frame_writer = ChunkWriter(writer)
+        aprint, aprompt = create_raw_prompt(frame_reader, frame_writer)
+        try:
+            line = await frame_reader.readline()
+            command = line.decode().rstrip("\n")
+            status = await run_command(
+                command, aprint, aprompt, allowed=framable)
+        except EOFError:
+            status = None
+        except UnicodeDecodeError:
+            await aprint("Please use UTF-8 encoding")
+            status = 1
+        except ValueError as exc:
+            await aprint(f"Invalid frame: {exc}")
+            status = 1
+        frame_writer.end(status or 0)
+        await writer.drain()
+        await frame_reader.discard()
+        if frame_reader.truncated:
+            return
 
 
 async def tcp_command_handler(reader, writer):
+    CONNECTIONS.inc(interface="tcp")
     aprint, aprompt = create_raw_prompt(reader, writer)
     try:
         command = await aprompt()
-        await run_command(command, aprint, aprompt)
+        with PRESENCE.tracking("sessions"):
+            if command == PIPELINE_KEYWORD:
+                aprint.nodelay()
+                await pipeline_handler(reader, writer)
+            else:
+                await run_command(command, aprint, aprompt)
     except EOFError:
         pass
     except UnicodeDecodeError:
@@ -24,6 +169,35 @@ async def tcp_command_handler(reader, writer):
             pass
 
 
-async def start_tcp_server(host="0.0.0.0", port=8000):
+async def worker_command_handler(reader, writer):
+    CONNECTIONS.inc(interface="worker")
+    aprint, aprompt = create_raw_prompt(reader, writer)
+    try:
+        command = await aprompt()
+        # Another worker took over the runner of this user
+        name, *args = shlex.split(command) or [None]
+        if name == DISCARD_COMMAND:
+            await discard_runner(*args)
+            status = 0
+        else:
+            status = await run_command(command, aprint, aprompt)
+        writer.write(STATUS_SEPARATOR + f"{status or 0}".encode())
+    except EOFError:
+        pass
+    except Exception:
+        log_exception()
+    finally:
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionResetError:
+            pass
+
+
+async def start_tcp_server(host="0.0.0.0", port=8000, reuse_port=None):
     return await asyncio.start_server(
-        tcp_command_handler, host=host, port=port)
+        tcp_command_handler, host=host, port=port, reuse_port=reuse_port)
+
+
+async def start_worker_server(path):
+    return await asyncio.start_unix_server(worker_command_handler, path)
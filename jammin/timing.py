@@ -1,8 +1,12 @@
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 
 now = datetime.now
+clock = time.perf_counter_ns
 TIMEREF = datetime.now()
+# Wall-clock time of a monotonic instant, so that only the clock
+# is read on the hot paths
+ANCHOR = now(), clock()
 
 
 def set_time_reference(value):
@@ -14,9 +18,33 @@ def get_time_reference():
     return TIMEREF
 
 
-def format_attempt(start, stop):
+def format_duration(duration):
+    return format(duration / 1e9, "06.3f")
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+def format_latencies(values):
+    return ", ".join(
+        f"p{int(ratio * 100)} {percentile(values, ratio) / 1e6:.3f}ms"
+        for ratio in (.5, .9, .99))
+
+
+def wall_time(stamp):
+    wall, monotonic = ANCHOR
+    return wall + timedelta(microseconds=(stamp - monotonic) // 1000)
+
+
+def format_attempt(start, stop, wall=None):
+    # Start and stop are monotonic nanoseconds from the clock,
+    # the wall-clock time is only used for display
+    if wall is None:
+        wall = wall_time(stop)
     reference = get_time_reference()
     after = time.strftime(
-        "%H:%M:%S", time.gmtime((stop - reference).total_seconds()))
-    took = format((stop - start).total_seconds(), "06.3f")
+        "%H:%M:%S", time.gmtime((wall - reference).total_seconds()))
+    took = format_duration(stop - start)
     return f"[{after}] [{took}]"
@@ -1,20 +1,174 @@
 
+import os
+import json
+import fcntl
+import asyncio
 import secrets
+import threading
+from contextlib import contextmanager
 
-USERS = {"123": "billy"}
+from .presence import PRESENCE
 
 
-def get_user(token):
-    return USERS[token]
+class UserStore:
 
+    def __init__(self, path=None, users=None):
+        self.path = path
+        self.tokens = {}
+        self.users = {}
+        self.offset = 0
+        self.journal = None
+        # Journal I/O runs in executor threads, and flock does not
+        # exclude the threads of a single process
+        self.lock = threading.Lock()
+        for token, user in (users or {}).items():
+            self._add(token, user)
+        if path is not None:
+            self.journal = open(path, "a+b")
+            with self.locked():
+                self._catch_up()
 
-def claim_user(user):
-    if user in USERS:
-        raise ValueError
-    token = secrets.token_hex(5)
-    USERS[token] = user
-    return token
+    def __len__(self):
+        return len(self.tokens)
+
+    def _add(self, token, user):
+        self.tokens[token] = user
+        self.users[user] = token
+
+    @contextmanager
+    def locked(self):
+        if self.journal is None:
+            yield
+            return
+        with self.lock:
+            fcntl.flock(self.journal, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.journal, fcntl.LOCK_UN)
+
+    def grown(self):
+        # Cheap check for records appended by other processes
+        if self.journal is None:
+            return False
+        return os.fstat(self.journal.fileno()).st_size != self.offset
+
+    def _catch_up(self):
+        # Apply the records appended since the last read,
+        # possibly by other processes sharing the journal
+        self.journal.seek(self.offset)
+        for line in self.journal:
+            if not line.endswith(b"\n"):
+                break
+            record = json.loads(line)
+            self._add(record["token"], record["user"])
+            self.offset += len(line)
+
+    def _write(self, records):
+        # Write-ahead: records are on disk before being visible
+        if self.journal is None:
+            return
+        self.journal.seek(0, 2)
+        for token, user in records:
+            line = json.dumps({"token": token, "user": user}) + "\n"
+            self.journal.write(line.encode())
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def get_user(self, token):
+        try:
+            return self.tokens[token]
+        except KeyError:
+            # Unknown tokens only cost a lock when the journal grew
+            if not self.grown():
+                raise
+        with self.locked():
+            self._catch_up()
+        return self.tokens[token]
+
+    def get_token(self, user):
+        return self.users[user]
+
+    def claim(self, user, token=None):
+        return self.claim_many([(user, token)])[user]
+
+    def claim_many(self, users):
+        with self.locked():
+            return self._claim_many(users)
+
+    def _claim_many(self, users):
+        if self.journal is not None:
+            self._catch_up()
+        records = []
+        claimed = set()
+        for user, token in users:
+            if user in self.users or user in claimed or token in self.tokens:
+                raise ValueError(user)
+            if token is None:
+                token = secrets.token_hex(5)
+                while token in self.tokens:
+                    token = secrets.token_hex(5)
+            records.append((token, user))
+            claimed.add(user)
+        self._write(records)
+        for token, user in records:
+            self._add(token, user)
+        if self.journal is not None:
+            self.offset = self.journal.tell()
+        return {user: token for token, user in records}
 
+    def register(self, lines):
+        # Bulk registration with optional tokens, existing users are kept
+        listed = [line.split()[:2] for line in lines if line.strip()]
+        with self.locked():
+            if self.journal is not None:
+                self._catch_up()
+            self._claim_many(
+                (user, token[0] if token else None)
+                for user, *token in listed
+                if user not in self.users)
+            return {user: self.users[user] for user, *_ in listed}
 
-def get_users():
-    return dict(USERS)
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+DEFAULT_USERS = {"123": "billy"}
+STORE = UserStore(users=DEFAULT_USERS)
+PRESENCE.set("users", len(STORE))
+
+
+def set_user_store(store):
+    global STORE
+    STORE = store
+    PRESENCE.set("users", len(store))
+
+
+def get_user_store():
+    return STORE
+
+
+async def get_user(token):
+    # Known tokens are served from memory, the journal
+    # is only read in an executor when it grew
+    try:
+        return STORE.tokens[token]
+    except KeyError:
+        if not STORE.grown():
+            raise
+    loop = asyncio.get_event_loop()
+    try:
+        return await loop.run_in_executor(None, STORE.get_user, token)
+    finally:
+        # The journal might have caught up with other processes
+        PRESENCE.set("users", len(STORE))
+
+
+async def claim_user(user):
+    # The journal is locked and synced in an executor
+    loop = asyncio.get_event_loop()
+    token = await loop.run_in_executor(None, STORE.claim, user)
+    PRESENCE.set("users", len(STORE))
+    return token
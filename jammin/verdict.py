@@ -0,0 +1,58 @@
+import asyncio
+
+from .stream import CHUNK_SIZE
+
+VERDICT_CHARS = {
+    b"passed": b".",
+    b"failed": b"F",
+    b"error": b"E",
+    b"skip": b"S"}
+UNKNOWN_CHAR = b"?"
+PASSED_CHAR = b"."
+FLUSH_INTERVAL = 0.05
+
+
+def parse_verdict(line):
+    return VERDICT_CHARS.get(line.strip().lower(), UNKNOWN_CHAR)
+
+
+async def read_verdicts(stream, aprint, interval=FLUSH_INTERVAL):
+    loop = asyncio.get_event_loop()
+    verdicts = bytearray()
+    pending = bytearray()
+    remainder = b""
+    handle = None
+
+    # Progress characters are coalesced and written every interval
+    def flush():
+        nonlocal handle
+        handle = None
+        # No progress is shown without a printer
+        if pending and aprint is not None:
+            aprint.sprint(pending.decode(), end='')
+        pending.clear()
+
+    try:
+        while True:
+            chunk = await stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            *lines, remainder = (remainder + chunk).split(b"\n")
+            for line in lines:
+                char = parse_verdict(line)
+                verdicts += char
+                pending += char
+            if pending and handle is None:
+                handle = loop.call_later(interval, flush)
+    finally:
+        if handle is not None:
+            handle.cancel()
+
+    # Last line might not be terminated
+    if remainder:
+        char = parse_verdict(remainder)
+        verdicts += char
+        pending += char
+
+    flush()
+    return verdicts
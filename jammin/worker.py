@@ -0,0 +1,162 @@
+import shlex
+import codecs
+import socket
+import asyncio
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing.managers import BaseManager
+
+from .stream import CHUNK_SIZE
+
+STATUS_SEPARATOR = b"\0"
+DISCARD_COMMAND = "discard"
+
+
+def reserve_port(port, host="0.0.0.0"):
+    # Bound but not listening: holds the port without receiving connections,
+    # while the workers listen on it with SO_REUSEPORT
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def worker_address(rundir, index):
+    return f"{rundir}/worker-{index}.sock"
+
+
+def create_rundir():
+    return tempfile.mkdtemp(prefix="jammin-")
+
+
+class Owners:
+
+    # Lives in the manager process, where each method call is atomic
+    def __init__(self):
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def get(self, user):
+        return self.owners.get(user)
+
+    def claim(self, user, address):
+        with self.lock:
+            previous = self.owners.get(user)
+            self.owners[user] = address
+            return previous
+
+    def release(self, user, address):
+        with self.lock:
+            if self.owners.get(user) != address:
+                return False
+            del self.owners[user]
+            return True
+
+
+class OwnersManager(BaseManager):
+    pass
+
+
+OwnersManager.register("Owners", Owners)
+
+
+def create_shared_state():
+    manager = OwnersManager(ctx=multiprocessing.get_context("fork"))
+    manager.start()
+    return manager, manager.Owners()
+
+
+def start_workers(namespace, target):
+    context = multiprocessing.get_context("fork")
+    namespace.ready = context.Semaphore(0)
+    processes = []
+    for index in range(namespace.workers):
+        namespace.worker = index
+        process = context.Process(target=target, args=(namespace,))
+        process.start()
+        processes.append(process)
+    namespace.worker = None
+    return processes
+
+
+def wait_workers(namespace, processes):
+    # Wait for all the workers to listen, or for one of them to fail
+    ready = 0
+    while ready < len(processes):
+        if namespace.ready.acquire(timeout=.1):
+            ready += 1
+        elif not all(process.is_alive() for process in processes):
+            return False
+    return True
+
+
+def stop_workers(processes):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join()
+
+
+async def proxy_command(session, address, command, args,
+                        first_line=None, first_data=b""):
+    reader, writer = await asyncio.open_unix_connection(address)
+    command = " ".join(map(shlex.quote, [command, *args]))
+    writer.write(f"{command}\n".encode())
+    if first_line is not None:
+        writer.write(f"{first_line}\n".encode())
+    writer.write(first_data)
+
+    async def upstream():
+        if hasattr(session.aprompt, "splice"):
+            await session.aprompt.splice(writer)
+        else:
+            while True:
+                try:
+                    line = await session.aprompt()
+                except EOFError:
+                    break
+                writer.write(f"{line}\n".encode())
+                await writer.drain()
+        writer.write_eof()
+
+    # Forward the output until the status trailer
+    task = asyncio.create_task(upstream())
+    try:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        trailer = None
+        while True:
+            chunk = await reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if trailer is not None:
+                trailer += chunk
+                continue
+            chunk, separator, rest = chunk.partition(STATUS_SEPARATOR)
+            if separator:
+                trailer = rest
+            await session.aprint(decoder.decode(chunk), end='')
+        return int(trailer) if trailer else None
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        writer.close()
+
+
+async def discard_remote(address, user):
+    # Only reachable by the other workers, through their unix socket
+    try:
+        reader, writer = await asyncio.open_unix_connection(address)
+    except OSError:
+        return
+    command = " ".join(map(shlex.quote, [DISCARD_COMMAND, user]))
+    writer.write(f"{command}\n".encode())
+    try:
+        await reader.read()
+    finally:
+        writer.close()
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+import sys
+import socket
+import subprocess
+
+# Unpack arguments
+_, hostname, port, token, *command = sys.argv
+
+# Initialize judge connection
+connection = socket.create_connection((hostname, port))
+connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+connection.send("judge {}\n".format(token).encode())
+
+# Run solver process, talking to the runner over the connection
+process = subprocess.run(
+    command,
+    stdin=connection,
+    stdout=connection,
+    shell=True, check=True)
+
+# Print status
+with connection.makefile("r", buffering=1) as f:
+    for line in f:
+        print(line, end='')
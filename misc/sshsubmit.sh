@@ -1,6 +1,8 @@
 #!/bin/bash
-ssh $1 "-p$2" request $3 |
-    tee data.in.tmp >(sed 's/^/< /' 1>&2) |
+# Single ssh channel: input data on stdout, output data on stdin,
+# verdicts and status on stderr
+coproc SOLVE { ssh $1 "-p$2" solve $3; }
+tee data.in.tmp >(sed 's/^/< /' 1>&2) <&${SOLVE[0]} |
     ${@:4} |
-    tee data.out.tmp >(sed 's/^/> /' 1>&2) |
-    ssh $1 "-p$2" submit $3
+    tee data.out.tmp >(sed 's/^/> /' 1>&2) >&${SOLVE[1]}
+wait $SOLVE_PID
@@ -1,26 +1,94 @@
 #!/usr/bin/env python3
 
 import sys
+import zlib
 import socket
+import argparse
+import threading
 import subprocess
 
-# Unpack arguments
-_, hostname, port, token, *command = sys.argv
+CHUNK_SIZE = 2**16
 
-# Initialize request connection
-request_connection = socket.create_connection((hostname, port))
-request_connection.send("request {}\n".format(token).encode())
+# Parse arguments
+parser = argparse.ArgumentParser(
+    description='Run a solver against a jammin server')
+parser.add_argument('-z', '--compress', choices=['zlib', 'zstd'],
+                    help='compress the datasets on the wire')
+parser.add_argument('hostname')
+parser.add_argument('port', type=int)
+parser.add_argument('token')
+parser.add_argument('command', nargs=argparse.REMAINDER)
+args = parser.parse_args()
+option = " --compress {}".format(args.compress) if args.compress else ""
 
-# Initialize submit connection
-submit_connection = socket.create_connection((hostname, port))
-submit_connection.send("submit {}\n".format(token).encode())
 
-# Run solver process
-process = subprocess.run(
-    command,
-    stdin=request_connection,
-    stdout=submit_connection,
-    shell=True, check=True)
+# Streaming codecs
+def codec_objects(codec):
+    if codec == 'zstd':
+        import zstandard
+        return (zstandard.ZstdCompressor().compressobj(),
+                zstandard.ZstdDecompressor().decompressobj())
+    return zlib.compressobj(), zlib.decompressobj()
+
+
+# Run solver process over a single connection
+if not args.compress:
+    connection = socket.create_connection((args.hostname, args.port))
+    connection.send("solve {}\n".format(args.token).encode())
+    process = subprocess.run(
+        args.command,
+        stdin=connection,
+        stdout=connection,
+        shell=True, check=True)
+
+    # Verdicts are sent once the output data is complete
+    connection.shutdown(socket.SHUT_WR)
+    submit_connection = connection
+
+# Run solver process, (de)compressing on the fly
+else:
+    request_connection = socket.create_connection(
+        (args.hostname, args.port))
+    request_connection.send(
+        "request {}{}\n".format(args.token, option).encode())
+    submit_connection = socket.create_connection(
+        (args.hostname, args.port))
+    submit_connection.send(
+        "submit {}{}\n".format(args.token, option).encode())
+    compressor, decompressor = codec_objects(args.compress)
+    process = subprocess.Popen(
+        args.command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        shell=True)
+
+    def download():
+        while True:
+            chunk = request_connection.recv(CHUNK_SIZE)
+            if not chunk:
+                break
+            process.stdin.write(decompressor.decompress(chunk))
+            process.stdin.flush()
+        process.stdin.write(getattr(decompressor, 'flush', bytes)())
+        process.stdin.close()
+
+    def upload():
+        while True:
+            chunk = process.stdout.read1(CHUNK_SIZE)
+            if not chunk:
+                break
+            submit_connection.sendall(compressor.compress(chunk))
+        submit_connection.sendall(compressor.flush())
+        submit_connection.shutdown(socket.SHUT_WR)
+
+    threads = [threading.Thread(target=download),
+               threading.Thread(target=upload)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if process.wait():
+        sys.exit(process.returncode)
 
 # Print status
 with submit_connection.makefile("r", buffering=1) as f:
@@ -1,8 +1,29 @@
 
+import os
+import sys
+import signal
+import zlib
 import asyncio
+from datetime import timedelta
 
 import pytest
-from jammin.server import amain
+from jammin.server import amain, parse_args
+from jammin.user import UserStore
+from jammin.dataset import DatasetCache, tee_to_cache, generate_dataset
+from jammin.process import RunnerProcess, RunnerLimits
+from jammin.runner import (
+    expire_runners, runner_stats, spawn_runner, close_runner)
+from jammin.scheduler import RunnerScheduler, SchedulerTimeout
+from jammin.description import get_render_cache
+from jammin.verdict import read_verdicts
+from jammin.scoreboard import Scoreboard
+from jammin.presence import get_presence, NOTIFY_DELAY
+from jammin.profiler import phase, profile
+from jammin.checklist import check_list
+from jammin.metrics import REQUEST_BYTES, SUBMIT_LINES
+from jammin.exception import log_exception, RateLimiter
+from jammin.timing import (
+    format_attempt, get_time_reference, wall_time, clock, now)
 
 RUNNER = """\
 import sys
@@ -21,20 +42,60 @@ with open(recv_fd, "r") as f:
         print("PASSED" if value == seed ** 2 else "FAILED")
 """
 
+CRASHING_RUNNER = """\
+import os, sys, signal
+seed, send_fd, recv_fd = map(int, sys.argv[1:])
+os.write(send_fd, b"%d\\n" % seed)
+os.kill(os.getpid(), signal.SIGKILL)
+"""
+
 SOLVER = """\
 print(int(input()) ** 2)
 """
 
 
-@pytest.fixture
+@pytest.fixture(
+    params=[{}, {"pool_size": 2}, {"cache": True, "pregenerate": True}],
+    ids=["default", "pool", "cache"])
 @pytest.mark.asyncio
-async def server():
+async def server(request, tmp_path):
     namespace = type("namespace", (), {})
     namespace.ssh_port = 0
     namespace.tcp_port = 0
-    namespace.max_seed = 10
-    namespace.ntests = None
+    namespace.maxseed = 10
+    namespace.ntests = 3
+    namespace.check_all = False
+    namespace.check_timeout = 30
+    namespace.baseline_runs = 1
+    namespace.max_ratio = None
     namespace.interactive = False
+    namespace.pool_size = 0
+    namespace.pool_high_water = 4
+    namespace.cache = None
+    namespace.cache_size = 64
+    namespace.pregenerate = False
+    namespace.users = None
+    namespace.scores = None
+    namespace.max_runners = 4
+    namespace.max_user_runners = 1
+    namespace.queue_timeout = 10
+    namespace.max_live_runners = 8
+    namespace.runner_ttl = 60
+    namespace.runner_cpu = 10
+    namespace.runner_memory = 2**30
+    namespace.runner_wall = 30
+    namespace.cgroup = None
+    namespace.register = None
+    namespace.admin_token = "admin"
+    namespace.metrics_port = 0
+    namespace.profile_dir = tmp_path / "profiles"
+    for key, value in request.param.items():
+        setattr(namespace, key, value)
+    if namespace.cache:
+        namespace.cache = tmp_path / "cache"
+    namespace.description = "example/standard-sum/description.md"
+    namespace.render_cache_size = 32
+    namespace.prerender = [80]
     namespace.runner = ["python", "-c", RUNNER]
     namespace.solver = ["python", "-c", SOLVER]
     namespace.started = asyncio.Event()
@@ -53,6 +114,14 @@ async def server():
         pass
 
 
+async def tcp_command(port, command, data=""):
+    reader, writer = await asyncio.open_connection("localhost", port)
+    writer.write(f"{command}\n{data}".encode())
+    result = (await reader.read()).decode().strip()
+    writer.close()
+    return result
+
+
 @pytest.mark.asyncio
 async def test_tcp_submission(server):
 
@@ -80,3 +149,603 @@ async def test_tcp_submission(server):
 
     # Check status
     assert status.endswith("1 / 1")
+
+
+@pytest.mark.asyncio
+async def test_tcp_scoreboard(server):
+    token = await tcp_command(server.tcp_port, "claim ranked")
+    data_in = await tcp_command(server.tcp_port, f"request {token}")
+    await tcp_command(
+        server.tcp_port, f"submit {token}", f"{int(data_in) ** 2}\n")
+
+    # Successful attempts are ranked
+    scoreboard = await tcp_command(server.tcp_port, "scoreboard")
+    assert scoreboard.splitlines()[1].split()[:5] == [
+        "1.", "ranked", "1", "/", "1"]
+
+
+@pytest.mark.asyncio
+async def test_tcp_baseline(server):
+    token = await tcp_command(server.tcp_port, "claim baseline")
+
+    # Attempts are compared to the reference solver
+    data_in = await tcp_command(server.tcp_port, f"request {token}")
+    status = await tcp_command(
+        server.tcp_port, f"submit {token}", f"{int(data_in) ** 2}\n")
+    assert status.splitlines()[-1].split()[2].endswith("x]")
+    assert status.endswith("1 / 1")
+
+    # And rejected when too slow
+    server.max_ratio = 1e-9
+    data_in = await tcp_command(server.tcp_port, f"request {token}")
+    status = await tcp_command(
+        server.tcp_port, f"submit {token}", f"{int(data_in) ** 2}\n")
+    assert "Too slow" in status
+    assert status.endswith("0 / 1")
+
+
+@pytest.mark.asyncio
+async def test_tcp_stats(server):
+    token = await tcp_command(server.tcp_port, "claim stats")
+    request_bytes = REQUEST_BYTES.values[()]
+    submit_lines = SUBMIT_LINES.values[()]
+    data_in = await tcp_command(server.tcp_port, f"request {token}")
+    await tcp_command(
+        server.tcp_port, f"submit {token}", f"{int(data_in) ** 2}\n")
+    assert REQUEST_BYTES.values[()] == request_bytes + len(data_in) + 1
+    assert SUBMIT_LINES.values[()] == submit_lines + 1
+
+    # Admin only
+    assert await tcp_command(server.tcp_port, "stats 123") == \
+        "Authentification failed: this token is not valid :("
+    stats = await tcp_command(server.tcp_port, "stats admin")
+    assert "# TYPE jammin_command_duration_seconds histogram" in stats
+    assert 'jammin_commands_total{command="submit",status="0"}' in stats
+    assert f"jammin_submit_lines_total {submit_lines + 1}" in stats
+
+    # Also exported over HTTP
+    port = server.metrics_port
+    reader, writer = await asyncio.open_connection("localhost", port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    response = (await reader.read()).decode()
+    writer.close()
+    assert response.startswith("HTTP/1.0 200 OK")
+    assert 'jammin_connections_total{interface="tcp"}' in response
+
+
+@pytest.mark.asyncio
+async def test_tcp_profile(server):
+    token = await tcp_command(server.tcp_port, "claim profile")
+    profile = asyncio.create_task(tcp_command(
+        server.tcp_port, "profile admin -d 1 --cprofile"))
+    await asyncio.sleep(0.2)
+    data_in = await tcp_command(server.tcp_port, f"request {token}")
+    await tcp_command(
+        server.tcp_port, f"submit {token}", f"{int(data_in) ** 2}\n")
+
+    # Phases are attributed separately
+    output = await profile
+    assert "run_command;request_command;create_runner" in output
+    filenames = [line.split()[-1] for line in output.splitlines()
+                 if line.startswith("Wrote")]
+    assert [name.rsplit(".", 1)[-1] for name in filenames] == [
+        "txt", "folded", "txt", "pstats"]
+    folded = open(filenames[1]).read()
+    assert "run_command;submit_command " in folded
+
+
+@pytest.mark.asyncio
+async def test_tcp_solve(server):
+    token = await tcp_command(server.tcp_port, "claim solve")
+
+    # Input and output data share a single connection
+    reader, writer = await asyncio.open_connection(
+        "localhost", server.tcp_port)
+    writer.write(f"solve {token}\n".encode())
+    value = int(await reader.readline())
+    writer.write(f"{value ** 2}\n".encode())
+    writer.write_eof()
+
+    # Verdicts follow the half-close
+    result = (await reader.read()).decode()
+    writer.close()
+    assert result.startswith(".\n")
+    assert result.strip().endswith("1 / 1")
+
+    # Without the half-close, verdicts follow the complete output data
+    reader, writer = await asyncio.open_connection(
+        "localhost", server.tcp_port)
+    writer.write(f"solve {token}\n".encode())
+    value = int(await reader.readline())
+    writer.write(f"{value ** 2}\n".encode())
+    result = (await asyncio.wait_for(reader.read(), 1)).decode()
+    writer.close()
+    assert result.strip().endswith("1 / 1")
+
+
+@pytest.mark.asyncio
+async def test_tcp_pipeline(server):
+    reader, writer = await asyncio.open_connection(
+        "localhost", server.tcp_port)
+
+    def send(command, data=""):
+        frame = f"{command}\n{data}".encode()
+        writer.write(b"%d\n" % len(frame) + frame)
+
+    async def receive():
+        chunks = []
+        while True:
+            size, *status = (await reader.readline()).split()
+            if not int(size):
+                return b"".join(chunks).decode(), int(status[0])
+            chunks.append(await reader.readexactly(int(size)))
+
+    # Commands are pipelined on a single connection
+    writer.write(b"pipeline\n")
+    send("claim pipeline")
+    send("claim pipeline")
+    send("scoreboard")
+    token, status = await receive()
+    token = token.strip()
+    assert status == 0
+    assert await receive() == ("This user name is already taken :)\n", 1)
+    assert (await receive())[0].startswith("Scoreboard")
+
+    # Including the ones with input data
+    send(f"request {token}")
+    data_in, _ = await receive()
+    send(f"submit {token}", f"{int(data_in) ** 2}\n")
+    output, status = await receive()
+    assert output.strip().endswith("1 / 1")
+    assert status == 0
+
+    # Only the commands with a bounded output are framed
+    send("scoreboard --watch")
+    send("interact")
+    assert (await receive())[1] == 3
+    assert await receive() == (
+        "The interact command is not available here\n", 3)
+
+    # Unread input data is skipped
+    send("claim pipelined", "unread\n" * 1000)
+    send("scoreboard")
+    assert (await receive())[1] == 0
+    assert (await receive())[0].startswith("Scoreboard")
+    writer.close()
+
+    # Plain connections are unchanged
+    assert await tcp_command(server.tcp_port, "claim pipeline") == \
+        "This user name is already taken :)"
+
+
+@pytest.mark.asyncio
+async def test_tcp_judge(server):
+    token = await tcp_command(server.tcp_port, "claim judge")
+    assert (await tcp_command(server.tcp_port, f"judge {token}")).startswith(
+        "This is not an interactive problem")
+
+    # Both directions are relayed on a single connection
+    server.interactive = True
+    reader, writer = await asyncio.open_connection(
+        "localhost", server.tcp_port)
+    writer.write(f"judge {token}\n".encode())
+    value = int(await reader.readline())
+    writer.write(f"{value ** 2}\n".encode())
+    result = (await reader.read()).decode()
+    writer.close()
+
+    # With the round-trip latencies
+    assert "1 turns, round-trip p50 " in result
+    assert result.strip().endswith("1 / 1")
+
+
+@pytest.mark.asyncio
+async def test_tcp_compression(server):
+    token = await tcp_command(server.tcp_port, "claim compression")
+
+    # Request compressed input data
+    reader, writer = await asyncio.open_connection(
+        "localhost", server.tcp_port)
+    writer.write(f"request {token} --compress zlib\n".encode())
+    data_in = zlib.decompress(await reader.read())
+    writer.close()
+
+    # Submit compressed output data
+    reader, writer = await asyncio.open_connection(
+        "localhost", server.tcp_port)
+    writer.write(f"submit {token} -z zlib\n".encode())
+    writer.write(zlib.compress(f"{int(data_in) ** 2}\n".encode()))
+    writer.write_eof()
+    status = (await reader.read()).decode().strip()
+    writer.close()
+    assert status.endswith("1 / 1")
+
+    # Corrupt output data does not leave the runner waiting
+    await tcp_command(server.tcp_port, f"request {token}")
+    reader, writer = await asyncio.open_connection(
+        "localhost", server.tcp_port)
+    writer.write(f"submit {token} -z zlib\n".encode())
+    writer.write(b"not compressed at all")
+    status = await asyncio.wait_for(reader.read(), 5)
+    writer.close()
+    assert b"Invalid compressed data" in status
+    assert runner_stats()["runners"] == 0
+
+
+@pytest.mark.asyncio
+async def test_runner_lifecycle(server):
+    token = await tcp_command(server.tcp_port, "claim lifecycle")
+
+    # Submitted runners are closed
+    data_in = await tcp_command(server.tcp_port, f"request {token}")
+    assert runner_stats()["runners"] == 1
+    await tcp_command(
+        server.tcp_port, f"submit {token}", f"{int(data_in) ** 2}\n")
+    assert runner_stats()["runners"] == 0
+
+    # Unused runners expire
+    fds = runner_stats()["fds"]
+    await tcp_command(server.tcp_port, f"request {token}")
+    assert runner_stats()["alive"] == 1
+    await expire_runners(0)
+    assert runner_stats()["runners"] == 0
+    assert runner_stats()["fds"] <= fds
+
+
+@pytest.mark.asyncio
+async def test_presence(server):
+    presence = get_presence()
+    users = presence["users"]
+    changes = []
+    with presence.watching(lambda values: changes.append(dict(values))):
+        token = await tcp_command(server.tcp_port, "claim presence")
+        assert presence["users"] == users + 1
+        data_in = await tcp_command(server.tcp_port, f"request {token}")
+        assert presence["runners"] == 1
+        await tcp_command(
+            server.tcp_port, f"submit {token}", f"{int(data_in) ** 2}\n")
+        assert presence["runners"] == 0
+
+        # Changes are batched, unchanged values are not pushed
+        await asyncio.sleep(2 * NOTIFY_DELAY)
+        notified = len(changes)
+        for _ in range(3):
+            presence.add("sessions")
+        await asyncio.sleep(2 * NOTIFY_DELAY)
+        assert [change["sessions"] for change in changes[notified:]] == [3]
+        presence.set("sessions", 0)
+        await asyncio.sleep(2 * NOTIFY_DELAY)
+        notified = len(changes)
+        presence.set("users", users + 1)
+        await asyncio.sleep(2 * NOTIFY_DELAY)
+        assert len(changes) == notified
+    presence.set("users", users + 2)
+    await asyncio.sleep(2 * NOTIFY_DELAY)
+
+    # Each connection is a session, closed after its command
+    assert changes
+    assert changes[-1] == {"users": users + 1, "sessions": 0, "runners": 0}
+
+
+@pytest.mark.asyncio
+async def test_tcp_usage(server):
+    usage = await tcp_command(server.tcp_port, "request")
+    assert usage.startswith("usage: request [-h] [-z {zlib,zstd}] TOKEN")
+    assert "Unknown command nope" == \
+        await tcp_command(server.tcp_port, "nope")
+
+
+@pytest.mark.asyncio
+async def test_tcp_show(server):
+    cache = get_render_cache()
+    hits = cache.hits
+    for _ in range(2):
+        assert "Sum of the N first integers" in \
+            await tcp_command(server.tcp_port, "show")
+    assert cache.hits == hits + 2
+    assert cache.misses == 1
+
+
+def count_processes(script):
+    count = 0
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                arguments = f.read().split(b"\0")
+        except OSError:
+            continue
+        count += arguments[1:2] == [script.encode()]
+    return count
+
+
+@pytest.mark.asyncio
+async def test_workers(tmp_path):
+    runner = tmp_path / "runner.py"
+    runner.write_text(f"#!{sys.executable}\n{RUNNER}")
+    runner.chmod(0o755)
+    (tmp_path / "description.md").write_text("Test\n====\n")
+
+    # Start the server with several workers
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "jammin", "-w", "3", "-t", "0", "-s", "0",
+        "-n", "0", "description.md", str(runner), "solver.py",
+        cwd=tmp_path, stdout=asyncio.subprocess.PIPE,
+        env={**os.environ, "PYTHONPATH": os.getcwd()})
+    try:
+        async for line in process.stdout:
+            if b"TCP" in line:
+                port = int(line.split()[-1].strip(b"."))
+            if b"workers" in line:
+                break
+
+        # Tokens and runners are shared by the workers
+        token = await tcp_command(port, "claim test")
+        assert await tcp_command(port, "claim test") == \
+            "This user name is already taken :)"
+        for _ in range(10):
+            data_in = await tcp_command(port, f"request {token}")
+            status = await tcp_command(
+                port, f"submit {token}", f"{int(data_in) ** 2}\n")
+            assert status.endswith("1 / 1")
+
+        # A new request replaces the previous runner, on any worker
+        for _ in range(6):
+            await tcp_command(port, f"request {token}")
+        assert count_processes(str(runner)) == 1
+
+    finally:
+        process.terminate()
+        await process.wait()
+
+
+@pytest.mark.asyncio
+async def test_check_list():
+    runner = ["python", "-c", RUNNER]
+    solver = ["python", "-c", SOLVER]
+    results, unchecked = await check_list(
+        runner, solver, 5, 10, workers=2, runs=3)
+    assert unchecked == 0
+    assert len({check.seed for check in results}) == 5
+    assert all(check.passed and check.duration > 0 for check in results)
+    assert all(0 < check.baseline < check.duration for check in results)
+
+    # Failing seeds are reported
+    solver = ["python", "-c", "print(1)"]
+    results, _ = await check_list(runner, solver, 3, 3)
+    assert [check.seed for check in results if not check.passed] == [0, 2]
+
+
+def test_parse_args():
+    args = ["desc.md", "runner.py", "solver.py"]
+    assert parse_args(args).ntests == 10
+    assert parse_args(["-n", "0", *args]).ntests == 0
+    with pytest.raises(SystemExit):
+        parse_args(["-n", "0", "--max-ratio", "2", *args])
+
+
+@pytest.mark.asyncio
+async def test_phase(tmp_path):
+    @phase("sleepy")
+    async def sleepy():
+        await asyncio.sleep(.2)
+        return 1
+
+    # Phases only account for the time spent running
+    task = asyncio.create_task(profile(tmp_path, .3))
+    await asyncio.sleep(0)
+    assert await sleepy() == 1
+    profiler = await task
+    assert 0 < profiler.folded[("sleepy",)] < 50_000_000
+
+
+def test_dataset_cache(tmp_path):
+    cache = DatasetCache(tmp_path, maxsize=2)
+    assert cache.get(1) is None
+    for seed in range(3):
+        cache.put(seed, f"{seed}\n".encode())
+    assert list(cache.memory) == [1, 2]
+
+    # Evicted datasets are still on disk
+    assert cache.get(0) == b"0\n"
+    assert list(cache.memory) == [2, 0]
+
+    # Datasets survive restarts
+    cache = DatasetCache(tmp_path)
+    assert 2 in cache
+    assert cache.get(2) == b"2\n"
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_dataset_partial(tmp_path):
+    cache = DatasetCache(tmp_path)
+    crashing = ["python", "-c", CRASHING_RUNNER]
+
+    # Only complete datasets are cached
+    for seed, program in [(1, ["python", "-c", RUNNER]), (2, crashing)]:
+        runner = await spawn_runner(program, seed)
+        reader = asyncio.StreamReader()
+        await tee_to_cache(cache, runner, reader)
+        assert await reader.read() == f"{seed}\n".encode()
+        await close_runner(runner)
+    assert 1 in cache
+    assert 2 not in cache
+
+    # Including the pregenerated ones
+    await generate_dataset(cache, crashing, 3)
+    assert 3 not in cache
+
+
+@pytest.mark.asyncio
+async def test_read_verdicts():
+    printed = []
+
+    async def aprint(*args, **kwargs):
+        pass
+    aprint.sprint = lambda value, end: printed.append(value)
+
+    stream = asyncio.StreamReader()
+    stream.feed_data(b"PASSED\nfailed\r\nEr")
+    stream.feed_data(b"ror\nnope\npassed")
+    stream.feed_eof()
+    verdicts = await read_verdicts(stream, aprint)
+    assert verdicts == b".FE?."
+    assert "".join(printed) == ".FE?."
+
+
+def test_format_attempt():
+    start = 1_000_000_000
+    stop = start + 12_345_678_901
+    wall = get_time_reference() + timedelta(hours=1, seconds=5)
+    assert format_attempt(start, stop, wall) == "[01:00:05] [12.346]"
+
+    # The wall-clock time is derived from the monotonic stop time
+    assert abs((wall_time(clock()) - now()).total_seconds()) < .1
+
+
+def test_log_exception(capsys):
+    def fail():
+        try:
+            raise RuntimeError("broken runner")
+        except RuntimeError:
+            log_exception()
+
+    # Identical tracebacks are logged at counts 1, 2, 4, 8...
+    for _ in range(10):
+        fail()
+    output = capsys.readouterr().out
+    assert output.count("Unexpected exception") == 1
+    assert output.count("Repeated exception: RuntimeError") == 3
+    assert "count=8" in output
+    assert "\x1b[" not in output
+
+    # Bursts are rate-limited
+    limiter = RateLimiter(rate=0, burst=2)
+    assert [limiter.allow() for _ in range(4)] == [True, True, False, False]
+    assert limiter.pop_suppressed() == 2
+    assert limiter.pop_suppressed() == 0
+
+
+def test_user_store(tmp_path):
+    path = tmp_path / "users.log"
+    store = UserStore(path)
+    token = store.claim("alice")
+    assert store.get_user(token) == "alice"
+    assert store.get_token("alice") == token
+    with pytest.raises(ValueError):
+        store.claim("alice")
+
+    # Bulk registration
+    tokens = store.register(["alice", "bob", "", "carol 0123456789"])
+    assert tokens["alice"] == token
+    assert tokens["carol"] == "0123456789"
+
+    # Another store sharing the journal sees the claims
+    other = UserStore(path)
+    assert other.get_user(tokens["bob"]) == "bob"
+    dave = store.claim("dave")
+    assert other.get_user(dave) == "dave"
+    with pytest.raises(ValueError):
+        other.claim("dave")
+    assert len(other) == 4
+
+    # Unknown tokens do not read the journal again
+    assert not other.grown()
+    with pytest.raises(KeyError):
+        other.get_user("unknown")
+    store.claim("erin")
+    assert other.grown()
+
+
+@pytest.mark.asyncio
+async def test_scoreboard(tmp_path):
+    path = tmp_path / "scores.log"
+    scoreboard = Scoreboard(path)
+    assert scoreboard.record("alice", 3, 5, 2000) == 1
+    assert scoreboard.record("bob", 5, 5, 9000) == 1
+    assert scoreboard.record("carol", 3, 5, 1000) == 2
+    assert scoreboard.rank("alice") == 3
+
+    # Only the best attempt of each user is ranked
+    assert scoreboard.record("alice", 2, 5, 10) == 3
+    assert scoreboard.record("alice", 5, 5, 8000) == 1
+    assert [key[3] for key in scoreboard.ranking] == ["alice", "bob", "carol"]
+
+    # Renders are shared until the next submission
+    rendered = scoreboard.render(top=2)
+    assert rendered.splitlines()[0] == "Scoreboard (3 users)"
+    assert len(rendered.splitlines()) == 3
+    assert scoreboard.render(top=2) is rendered
+
+    # Other processes see the same ranking
+    other = Scoreboard(path)
+    assert other.ranking == scoreboard.ranking
+    assert other.attempts["alice"] == 3
+
+    # Watchers are notified of the changes
+    watch = scoreboard.watch(top=1)
+    assert await watch.__anext__() == scoreboard.render(top=1)
+    other.record("dave", 5, 5, 100)
+    rendered = await asyncio.wait_for(watch.__anext__(), 2)
+    assert "dave" in rendered
+    await watch.aclose()
+
+    # Records are written off the loop
+    assert await scoreboard.arecord("erin", 1, 5, 10) == 5
+    other.refresh()
+    assert other.ranking == scoreboard.ranking
+
+
+@pytest.mark.asyncio
+async def test_runner_scheduler():
+    scheduler = RunnerScheduler(limit=1, timeout=1)
+    await scheduler.acquire("a")
+
+    # Requests are queued
+    order = []
+
+    async def request(user):
+        await scheduler.acquire(user)
+        order.append(user)
+
+    tasks = [asyncio.create_task(request(user)) for user in "aab"]
+    await asyncio.sleep(0)
+    assert scheduler.stats()["queued"] == 3
+
+    # And served round-robin across users
+    for user in "aab":
+        scheduler.release(user)
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    assert order == ["a", "b", "a"]
+
+    # Until the queue timeout
+    scheduler.timeout = 0.01
+    with pytest.raises(SchedulerTimeout):
+        await scheduler.acquire("c")
+    assert scheduler.stats()["queued"] == 0
+
+
+@pytest.mark.asyncio
+async def test_runner_limits():
+    # CPU time
+    process = await RunnerProcess.spawn(
+        [sys.executable, "-c", "while True: pass"],
+        limits=RunnerLimits(cpu=1))
+    assert await process.wait() == -signal.SIGXCPU
+    assert process.usage["cpu"] > 0.5
+
+    # Address space
+    process = await RunnerProcess.spawn(
+        [sys.executable, "-c", "x = bytearray(2**28)"],
+        limits=RunnerLimits(memory=2**27))
+    assert await process.wait() == 1
+    assert process.usage["memory"] < 2**27
+
+    # Applied before the runner starts
+    process = await RunnerProcess.spawn(
+        [sys.executable, "-c",
+         "import resource; print(resource.getrlimit(resource.RLIMIT_CPU))"],
+        limits=RunnerLimits(cpu=5))
+    assert await process.stdout.read() == b"(5, 6)\n"
+    assert await process.wait() == 0